@@ -3,7 +3,9 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
 import json
 import mimetypes
+import os
 from werkzeug import exceptions, url_decode
+from werkzeug.wsgi import wrap_file
 
 from odoo.http import route, request
 
@@ -14,6 +16,8 @@ from odoo.addons.web.controllers.main import (
 )
 from odoo.tools import html_escape
 
+STREAM_BUFFER_SIZE = 64 * 1024
+
 
 class ReportController(main.ReportController):
 
@@ -49,15 +53,36 @@ class ReportController(main.ReportController):
         py3o_report = request.env['py3o.report'].create({
             'ir_actions_report_xml_id': action_py3o_report.id
         }).with_context(context)
-        res, filetype = py3o_report.create_report(docids, data)
-        filename = action_py3o_report.gen_report_download_filename(
+        result_path, filetype = py3o_report._create_report_file(
             docids, data)
-        content_type = mimetypes.guess_type("x." + filetype)[0]
-        http_headers = [('Content-Type', content_type),
-                        ('Content-Length', len(res)),
-                        ('Content-Disposition', content_disposition(filename))
-                        ]
-        return request.make_response(res, headers=http_headers)
+        result_file = None
+        try:
+            filename = action_py3o_report.gen_report_download_filename(
+                docids, data)
+            content_type = mimetypes.guess_type("x." + filetype)[0]
+            http_headers = [
+                ('Content-Type', content_type),
+                ('Content-Length', os.stat(result_path).st_size),
+                ('Content-Disposition', content_disposition(filename))
+            ]
+            # stream the result file instead of loading it in memory
+            result_file = open(result_path, 'rb')
+            response = request.make_response(
+                wrap_file(request.httprequest.environ, result_file,
+                          buffer_size=STREAM_BUFFER_SIZE),
+                headers=http_headers)
+            response.direct_passthrough = True
+        except Exception:
+            if result_file is not None:
+                result_file.close()
+            py3o_report._cleanup_tempfiles([result_path])
+            raise
+
+        @response.call_on_close
+        def cleanup():
+            result_file.close()
+            py3o_report._cleanup_tempfiles([result_path])
+        return response
 
     @route()
     def report_download(self, data, token):
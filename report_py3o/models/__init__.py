@@ -1,4 +1,5 @@
 from . import ir_actions_report_xml
+from . import ir_model_data
 from . import py3o_template
 from . import report
 from . import py3o_report
@@ -31,6 +31,32 @@ class IrActionsReportXml(models.Model):
                 raise ValidationError(_(
                     "Field 'Output Format' is required for Py3O report"))
 
+    @api.multi
+    @api.constrains("py3o_prefetch", "model")
+    def _check_py3o_prefetch(self):
+        for report in self:
+            if report.model not in self.env:
+                continue
+            for path in report._get_py3o_prefetch_paths():
+                model = self.env[report.model]
+                for fname in path.split('.'):
+                    if model is None or fname not in model._fields:
+                        raise ValidationError(_(
+                            "Invalid field path '%s' in the fields to "
+                            "prefetch") % path)
+                    field = model._fields[fname]
+                    model = self.env[field.comodel_name] \
+                        if field.relational else None
+
+    @api.multi
+    def _get_py3o_prefetch_paths(self):
+        self.ensure_one()
+        return [
+            path.strip()
+            for path in (self.py3o_prefetch or '').splitlines()
+            if path.strip()
+        ]
+
     @api.model
     def _get_py3o_filetypes(self):
         formats = Formats()
@@ -67,6 +93,12 @@ class IrActionsReportXml(models.Model):
         "by default Odoo will generate a ZIP file that contains as many "
         "files as selected records. If you enable this option, Odoo will "
         "generate instead a single report for the selected records.")
+    py3o_prefetch = fields.Text(
+        string='Fields to Prefetch',
+        help="Field paths read for all the records before rendering the "
+        "report, one per line (e.g. partner_id.country_id.name or "
+        "line_ids.product_id.default_code). Reading the fields used by the "
+        "template at once avoids running queries for each record.")
 
     @api.model
     def get_from_report_name(self, report_name, report_type):
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from odoo import api, models
+
+# the fields identifying the record of an xml id
+XML_ID_FIELDS = ('module', 'name', 'model', 'res_id')
+
+
+class IrModelData(models.Model):
+    """ The extenders of the py3o reports are registered on xml ids, clear
+    their cached resolution when the xml ids of py3o report actions change.
+    """
+    _inherit = 'ir.model.data'
+
+    @api.multi
+    def _has_py3o_reports(self):
+        """ Return whether some of these xml ids belong to py3o report
+        actions
+        """
+        res_ids = [
+            data.res_id for data in self
+            if data.model == 'ir.actions.report.xml'
+        ]
+        if not res_ids:
+            return False
+        return bool(self.env['ir.actions.report.xml'].sudo().search_count([
+            ('id', 'in', res_ids),
+            ('report_type', '=', 'py3o'),
+        ]))
+
+    @api.model
+    def create(self, vals):
+        record = super(IrModelData, self).create(vals)
+        if record._has_py3o_reports():
+            self.clear_caches()
+        return record
+
+    @api.multi
+    def write(self, vals):
+        # the xml ids are written again when their module is updated: only
+        # the ones actually moved to another record matter
+        changed = self.filtered(lambda data: any(
+            field in vals and data[field] != vals[field]
+            for field in XML_ID_FIELDS))
+        clear = changed._has_py3o_reports()
+        res = super(IrModelData, self).write(vals)
+        if clear or changed._has_py3o_reports():
+            self.clear_caches()
+        return res
+
+    @api.multi
+    def unlink(self):
+        clear = self._has_py3o_reports()
+        res = super(IrModelData, self).unlink()
+        if clear:
+            self.clear_caches()
+        return res
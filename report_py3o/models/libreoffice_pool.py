@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
+"""Pool of long-lived headless LibreOffice processes.
+
+Each worker is a ``soffice`` process with its own user profile, listening on
+a private UNO pipe. Conversions are sent to an idle worker instead of
+starting a new LibreOffice for every document.
+"""
+import atexit
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import Queue
+
+logger = logging.getLogger(__name__)
+
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+    from com.sun.star.connection import NoConnectException
+except ImportError:
+    uno = None
+    logger.debug('Cannot import uno')
+
+# filters used for pdf exports, depending on the kind of document loaded
+PDF_EXPORT_FILTERS = [
+    ('com.sun.star.sheet.SpreadsheetDocument', 'calc_pdf_Export'),
+    ('com.sun.star.presentation.PresentationDocument', 'impress_pdf_Export'),
+    ('com.sun.star.drawing.DrawingDocument', 'draw_pdf_Export'),
+    ('com.sun.star.text.TextDocument', 'writer_pdf_Export'),
+]
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class LibreOfficePoolError(Exception):
+    pass
+
+
+def is_available():
+    """The pool needs the python UNO bridge shipped with LibreOffice"""
+    return uno is not None
+
+
+def _properties(**kwargs):
+    res = []
+    for name, value in kwargs.items():
+        prop = PropertyValue()
+        prop.Name = name
+        prop.Value = value
+        res.append(prop)
+    return tuple(res)
+
+
+class LibreOfficeWorker(object):
+    """A headless LibreOffice process driven through UNO"""
+
+    def __init__(self, command, start_timeout=60):
+        self.command = command
+        self.start_timeout = start_timeout
+        self.jobs = 0
+        self.process = None
+        self.desktop = None
+        self.profile_dir = None
+
+    @property
+    def connection_string(self):
+        return 'pipe,name=%s;urp;StarOffice.ComponentContext' % (
+            os.path.basename(self.profile_dir))
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.profile_dir = tempfile.mkdtemp(prefix='py3o-lo-')
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen([
+                self.command,
+                '--headless',
+                '--invisible',
+                '--nologo',
+                '--nodefault',
+                '--norestore',
+                '--nolockcheck',
+                '-env:UserInstallation=%s' % uno.systemPathToFileUrl(
+                    self.profile_dir),
+                '--accept=%s;' % self.connection_string,
+            ], stdout=devnull, stderr=devnull)
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local_context)
+        deadline = time.time() + self.start_timeout
+        while True:
+            try:
+                context = resolver.resolve('uno:' + self.connection_string)
+                break
+            except NoConnectException:
+                if not self.is_alive() or time.time() > deadline:
+                    self.stop()
+                    raise LibreOfficePoolError(
+                        'Unable to start LibreOffice worker %s' %
+                        self.command)
+                time.sleep(0.1)
+        self.desktop = context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.frame.Desktop', context)
+        logger.debug('LibreOffice worker %s started', self.process.pid)
+
+    def kill(self):
+        if self.is_alive():
+            logger.warning(
+                'Killing LibreOffice worker %s', self.process.pid)
+            self.process.kill()
+
+    def stop(self):
+        if self.desktop is not None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                logger.debug('Error while terminating LibreOffice worker',
+                             exc_info=True)
+            self.desktop = None
+        if self.is_alive():
+            # give it a chance to exit cleanly after terminate()
+            for dummy in range(20):
+                if self.process.poll() is not None:
+                    break
+                time.sleep(0.1)
+            self.kill()
+        if self.process is not None:
+            self.process.wait()
+        if self.profile_dir:
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+            self.profile_dir = None
+
+    def _filter_name(self, document, filetype, default_filter):
+        if filetype == 'pdf':
+            for service, filter_name in PDF_EXPORT_FILTERS:
+                if document.supportsService(service):
+                    return filter_name
+        return default_filter
+
+    def convert(self, path, filetype, filter_name, timeout):
+        """Convert ``path`` into ``filetype`` and return the path of the
+        converted file, created next to the source like ``--convert-to``
+        does.
+        """
+        target = '%s.%s' % (os.path.splitext(path)[0], filetype)
+        timer = threading.Timer(timeout, self.kill)
+        timer.start()
+        document = None
+        try:
+            document = self.desktop.loadComponentFromURL(
+                uno.systemPathToFileUrl(path), '_blank', 0,
+                _properties(Hidden=True))
+            document.storeToURL(
+                uno.systemPathToFileUrl(target),
+                _properties(
+                    FilterName=self._filter_name(
+                        document, filetype, filter_name),
+                    Overwrite=True,
+                ))
+        except Exception as e:
+            if not self.is_alive():
+                raise LibreOfficePoolError(
+                    'LibreOffice worker killed after %s seconds while '
+                    'converting %s' % (timeout, path))
+            raise LibreOfficePoolError(
+                'LibreOffice failed to convert %s: %s' % (path, e))
+        finally:
+            timer.cancel()
+            if document is not None and self.is_alive():
+                try:
+                    document.close(True)
+                except Exception:
+                    logger.debug('Error while closing %s', path,
+                                 exc_info=True)
+        self.jobs += 1
+        return target
+
+
+class LibreOfficePool(object):
+    """A bounded set of LibreOffice workers shared by the threads of the
+    current process.
+
+    :param command: the LibreOffice executable
+    :param size: the maximum number of workers
+    :param max_jobs: restart a worker after that many conversions
+        (0 means never)
+    :param timeout: kill a worker when a conversion lasts longer than that
+        many seconds
+    """
+
+    def __init__(self, command, size, max_jobs=0, timeout=120):
+        self.command = command
+        self.size = size
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        # a replaced pool stops its workers once they are released
+        self.draining = False
+        self._idle = Queue.LifoQueue()
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self._lock:
+            spawn = self._count < self.size
+            if spawn:
+                self._count += 1
+        if not spawn:
+            try:
+                return self._idle.get(timeout=self.timeout)
+            except Queue.Empty:
+                raise LibreOfficePoolError(
+                    'No LibreOffice worker available after %s seconds' %
+                    self.timeout)
+        worker = LibreOfficeWorker(self.command)
+        try:
+            worker.start()
+        except Exception:
+            self._discard(worker)
+            raise
+        return worker
+
+    def _discard(self, worker):
+        with self._lock:
+            self._count -= 1
+        worker.stop()
+
+    def _release(self, worker):
+        with self._lock:
+            keep = not self.draining and worker.is_alive() and not (
+                self.max_jobs and worker.jobs >= self.max_jobs)
+            if keep:
+                self._idle.put(worker)
+        if not keep:
+            logger.debug('Recycling LibreOffice worker after %d jobs',
+                         worker.jobs)
+            self._discard(worker)
+
+    def convert(self, path, filetype, filter_name):
+        worker = self._acquire()
+        try:
+            return worker.convert(path, filetype, filter_name, self.timeout)
+        finally:
+            self._release(worker)
+
+    def shutdown(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            self._discard(worker)
+
+    def drain(self):
+        """Stop the idle workers, and the busy ones once released"""
+        with self._lock:
+            self.draining = True
+        self.shutdown()
+
+
+def get_pool(command, size, max_jobs=0, timeout=120):
+    """Return the pool of the current process for the given settings,
+    draining the previous one if the settings changed.
+    """
+    key = (command, size, max_jobs, timeout)
+    with _pools_lock:
+        pool = _pools.get(command)
+        if pool is not None and (
+                pool.command, pool.size, pool.max_jobs, pool.timeout) != key:
+            pool.drain()
+            pool = None
+        if pool is None:
+            pool = _pools[command] = LibreOfficePool(*key)
+        return pool
+
+
+def reset_after_fork():
+    """Forget the pools inherited from a parent process: their UNO bridges
+    can't be shared, the child will start its own workers.
+    """
+    _pools.clear()
+
+
+@atexit.register
+def shutdown_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown()
+        _pools.clear()
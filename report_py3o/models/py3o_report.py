@@ -4,26 +4,35 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
 import base64
 from base64 import b64decode
-from cStringIO import StringIO
 import logging
 import os
 import cgi
 from contextlib import closing
+import multiprocessing
+import multiprocessing.util
 import subprocess
 
 import pkg_resources
+import signal
 import sys
 import tempfile
-from zipfile import ZipFile, ZIP_DEFLATED
+import threading
+import time
+import traceback
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
-from odoo.exceptions import AccessError
+import odoo
+from odoo.exceptions import AccessError, UserError
 from odoo.report.report_sxw import rml_parse
+from odoo.tools.safe_eval import safe_eval
 from odoo import api, fields, models, tools, _
 
+from . import libreoffice_pool
+from . import template_cache
+
 logger = logging.getLogger(__name__)
 
 try:
-    from py3o.template import Template
     from py3o import formats
     from genshi.core import Markup
 except ImportError:
@@ -36,6 +45,12 @@ except ImportError:
 
 _extender_functions = {}
 
+# formats which are already compressed
+ZIP_STORED_EXTENSIONS = (
+    'pdf', 'png', 'jpg', 'jpeg', 'gif', 'zip',
+    'odt', 'ods', 'odp', 'odg', 'docx', 'xlsx', 'pptx',
+)
+
 
 class TemplateNotFound(Exception):
     pass
@@ -80,6 +95,75 @@ def defautl_extend(report_xml, localcontext):
     localcontext['html_sanitize'] = tools.html2plaintext
 
 
+def _init_render_worker():
+    """Initialize a process of the parallel rendering pool"""
+    # the signal handlers of the Odoo worker would keep the process alive
+    # when the pool is terminated
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # the database connections inherited from the parent process are still
+    # used by it: the worker must open its own ones
+    odoo.sql_db._Pool = None
+    libreoffice_pool.reset_after_fork()
+    # the workers of the pool leave through os._exit, which skips the atexit
+    # hooks: stop the LibreOffice processes they started with a finalizer
+    multiprocessing.util.Finalize(
+        None, libreoffice_pool.shutdown_pools, exitpriority=10)
+
+
+def _render_single_report_worker(args):
+    """Render the report of one record in a process of the parallel
+    rendering pool, using a cursor of its own.
+    """
+    dbname, uid, context, report_xml_id, res_id, data = args
+    try:
+        db = odoo.sql_db.db_connect(dbname)
+        with api.Environment.manage(), closing(db.cursor()) as cr:
+            env = api.Environment(cr, uid, context)
+            py3o_report = env['py3o.report'].create({
+                'ir_actions_report_xml_id': report_xml_id,
+            })
+            model_instance = env[
+                py3o_report.ir_actions_report_xml_id.model].browse(res_id)
+            # attachments are saved by the parent process, in its
+            # transaction
+            result_path = py3o_report._create_single_report(
+                model_instance, data, {})
+            cr.rollback()
+    except Exception as e:
+        # only the exception is sent back to the parent process
+        e.worker_traceback = traceback.format_exc()
+        raise
+    return result_path
+
+
+class SpooledResultFile(tempfile.SpooledTemporaryFile):
+    """ A buffer kept in memory until its size exceeds ``max_size``, then
+    moved to ``result_file`` instead of an anonymous temporary file, so the
+    document is written to the disk only once.
+    """
+
+    def __init__(self, result_file, max_size):
+        tempfile.SpooledTemporaryFile.__init__(self, max_size=max_size)
+        self._result_file = result_file
+
+    def rollover(self):
+        if self._rolled:
+            return
+        buf = self._file
+        self._file = self._result_file
+        self._file.write(buf.getvalue())
+        self._file.seek(buf.tell(), 0)
+        self._rolled = True
+
+    def write_result(self):
+        """ Write the document to the result file if it is still in memory
+        """
+        if not self._rolled:
+            self._result_file.write(self._file.getvalue())
+        self._result_file.flush()
+
+
 class Py3oReport(models.TransientModel):
     _name = "py3o.report"
     _inherit = 'report'
@@ -128,9 +212,9 @@ class Py3oReport(models.TransientModel):
         return False
 
     @api.multi
-    def _get_template_from_path(self, tmpl_name):
-        """ Return the template from the path to root of the module if specied
-        or an absolute path on your server
+    def _get_template_filename(self, tmpl_name):
+        """ Return the path of the template from the path to root of the
+        module if specified or an absolute path on your server
         """
         if not tmpl_name:
             return None
@@ -145,7 +229,17 @@ class Py3oReport(models.TransientModel):
         elif self._is_valid_template_path(tmpl_name):
             flbk_filename = os.path.realpath(tmpl_name)
         if self._is_valid_template_filename(flbk_filename):
-            with open(flbk_filename, 'r') as tmpl:
+            return flbk_filename
+        return None
+
+    @api.multi
+    def _get_template_from_path(self, tmpl_name):
+        """ Return the template from the path to root of the module if specied
+        or an absolute path on your server
+        """
+        filename = self._get_template_filename(tmpl_name)
+        if filename:
+            with open(filename, 'r') as tmpl:
                 return tmpl.read()
         return None
 
@@ -194,15 +288,53 @@ class Py3oReport(models.TransientModel):
         return tmpl_data
 
     @api.multi
-    def _extend_parser_context(self, context_instance, report_xml):
+    def _get_cached_template(self, model_instance):
+        """Return the parsed template used for ``model_instance``. Each
+        template returned by get_template is parsed once per process.
+        """
+        self.ensure_one()
+        cache = template_cache.cache
+        tmpl_data = self.get_template(model_instance)
+        tmpl_hash = template_cache.template_hash(tmpl_data)
+        cached_template = cache.get(tmpl_hash)
+        if not cached_template:
+            cached_template = template_cache.CachedTemplate(
+                tmpl_data, tmpl_hash=tmpl_hash)
+            cache.max_size = 1024 * 1024 * int(
+                self.env['ir.config_parameter'].get_param(
+                    'py3o.template_cache_size', 64))
+            cache.set(tmpl_hash, cached_template)
+        return cached_template
+
+    @api.multi
+    def _get_py3o_template(self, model_instance, out_stream):
+        """Return the py3o Template to render for ``model_instance`` into
+        ``out_stream``.
+        """
+        return self._get_cached_template(model_instance).new_template(
+            out_stream)
+
+    @api.model
+    @tools.ormcache('report_xml_id')
+    def _get_extender_functions(self, report_xml_id):
+        """ Return the extenders to apply to the context of a report: the
+        default extenders then the ones registered on its xml id.
+        The result is cached until ir.model.data is modified.
+        """
+        report_xml = self.env['ir.actions.report.xml'].sudo().browse(
+            report_xml_id)
         # add default extenders
-        for fct in _extender_functions.get(None, []):
-            fct(report_xml, context_instance.localcontext)
+        extenders = list(_extender_functions.get(None, []))
         # add extenders for registered on the template
         xml_id = report_xml.get_external_id().get(report_xml.id)
-        if xml_id in _extender_functions:
-            for fct in _extender_functions[xml_id]:
-                fct(report_xml, context_instance.localcontext)
+        if xml_id:
+            extenders += _extender_functions.get(xml_id, [])
+        return tuple(extenders)
+
+    @api.multi
+    def _extend_parser_context(self, context_instance, report_xml):
+        for fct in self._get_extender_functions(report_xml.id):
+            fct(report_xml, context_instance.localcontext)
 
     @api.multi
     def _get_parser_context(self, model_instance, data):
@@ -215,77 +347,200 @@ class Py3oReport(models.TransientModel):
         self._extend_parser_context(context_instance, report_xml)
         return context_instance.localcontext
 
+    @api.model
+    def _check_attachment_use(self, docids, report):
+        """ Same as report._check_attachment_use, but the stored documents
+        of all the records are looked up with a single search.
+        """
+        save_in_attachment = {
+            'model': report.model,
+            'loaded_documents': {},
+        }
+        if not report.attachment:
+            return save_in_attachment
+        filenames = {}
+        for record in self.env[report.model].browse(docids):
+            filename = safe_eval(report.attachment,
+                                 {'object': record, 'time': time})
+            # the expression may return False to not save the document
+            if filename:
+                filenames[record.id] = filename
+        loaded_documents = save_in_attachment['loaded_documents']
+        if report.attachment_use and filenames:
+            attachments = self.env['ir.attachment'].search([
+                ('res_model', '=', report.model),
+                ('res_id', 'in', filenames.keys()),
+                ('datas_fname', 'in', list(set(filenames.values()))),
+            ])
+            # the most recent attachments come first
+            for attachment in attachments:
+                if attachment.res_id in loaded_documents or \
+                        filenames[attachment.res_id] != \
+                        attachment.datas_fname:
+                    continue
+                loaded_documents[attachment.res_id] = b64decode(
+                    attachment.datas)
+            logger.info(
+                '%d of %d documents of report %s loaded from attachments',
+                len(loaded_documents), len(docids), report.report_name)
+        for res_id, filename in filenames.items():
+            if res_id not in loaded_documents:
+                save_in_attachment[res_id] = filename
+        return save_in_attachment
+
+    @api.multi
+    def _prefetch_records(self, model_instances):
+        """ Read the fields to prefetch of the report for all the records at
+        once, so the templates find them in the cache.
+        """
+        self.ensure_one()
+        report_xml = self.ir_actions_report_xml_id
+        for path in report_xml._get_py3o_prefetch_paths():
+            records = model_instances
+            for fname in path.split('.'):
+                if not isinstance(records, models.BaseModel) or \
+                        not records:
+                    break
+                records = records.mapped(fname)
+
     @api.model
     def _postprocess_report(self, report_path, res_id, save_in_attachment):
         if save_in_attachment.get(res_id):
             with open(report_path, 'rb') as pdfreport:
-                attachment = {
-                    'name': save_in_attachment.get(res_id),
-                    'datas': base64.encodestring(pdfreport.read()),
-                    'datas_fname': save_in_attachment.get(res_id),
-                    'res_model': save_in_attachment.get('model'),
-                    'res_id': res_id,
-                }
-                try:
-                    self.env['ir.attachment'].create(attachment)
-                except AccessError:
-                    logger.info("Cannot save PDF report %r as attachment",
-                                attachment['name'])
-                else:
-                    logger.info(
-                        'The PDF document %s is now saved in the database',
-                        attachment['name'])
+                self._postprocess_report_data(
+                    pdfreport.read(), res_id, save_in_attachment)
+
+    @api.model
+    def _postprocess_report_data(self, report_data, res_id,
+                                 save_in_attachment):
+        if save_in_attachment.get(res_id):
+            attachment = {
+                'name': save_in_attachment.get(res_id),
+                'datas': base64.encodestring(report_data),
+                'datas_fname': save_in_attachment.get(res_id),
+                'res_model': save_in_attachment.get('model'),
+                'res_id': res_id,
+            }
+            try:
+                self.env['ir.attachment'].create(attachment)
+            except AccessError:
+                logger.info("Cannot save PDF report %r as attachment",
+                            attachment['name'])
+            else:
+                logger.info(
+                    'The PDF document %s is now saved in the database',
+                    attachment['name'])
+
+    @api.multi
+    def _new_spooled_file(self, result_file):
+        """ Return a buffer kept in memory until its size exceeds
+        py3o.spool_max_size megabytes, then moved to ``result_file``
+        """
+        max_size = int(self.env['ir.config_parameter'].get_param(
+            'py3o.spool_max_size', 16))
+        return SpooledResultFile(result_file, max_size * 1024 * 1024)
+
+    @api.multi
+    def _render_single_report(self, model_instance, data, out_stream):
+        """ Render the template for ``model_instance`` into ``out_stream``
+        """
+        self.ensure_one()
+        template = self._get_py3o_template(model_instance, out_stream)
+        localcontext = self._get_parser_context(model_instance, data)
+        template.render(localcontext)
 
     @api.multi
     def _create_single_report(self, model_instance, data, save_in_attachment):
         """ This function to generate our py3o report
         """
         self.ensure_one()
+        skip_conversion = self.env.context.get('report_py3o_skip_conversion')
+        filetype = self.ir_actions_report_xml_id.py3o_filetype
+        # documents in a native format are saved as attachment from the
+        # rendering buffer
+        save_rendered = (
+            not skip_conversion and
+            Formats().get_format(filetype).native and
+            len(model_instance) == 1 and
+            save_in_attachment.get(model_instance.id))
         result_fd, result_path = tempfile.mkstemp(
             suffix='.ods', prefix='p3o.report.tmp.')
-        tmpl_data = self.get_template(model_instance)
-
-        in_stream = StringIO(tmpl_data)
-        with closing(os.fdopen(result_fd, 'w+')) as out_stream:
-            template = Template(in_stream, out_stream, escape_false=True)
-            localcontext = self._get_parser_context(model_instance, data)
-            template.render(localcontext)
-            out_stream.seek(0)
-            tmpl_data = out_stream.read()
-
-        if self.env.context.get('report_py3o_skip_conversion'):
+        # the template writes the document in many small chunks and seeks
+        # in it: render it in memory and write the result file at once,
+        # unless the document grows too big to be kept in memory
+        with closing(os.fdopen(result_fd, 'w+b')) as result_file, \
+                closing(self._new_spooled_file(result_file)) as out_stream:
+            self._render_single_report(model_instance, data, out_stream)
+            out_stream.write_result()
+            if save_rendered:
+                out_stream.seek(0)
+                self._postprocess_report_data(
+                    out_stream.read(), model_instance.id, save_in_attachment)
+
+        if skip_conversion:
             return result_path
 
         result_path = self._convert_single_report(
             result_path, model_instance, data
         )
 
-        if len(model_instance) == 1:
+        if len(model_instance) == 1 and not save_rendered:
             self._postprocess_report(
                 result_path, model_instance.id, save_in_attachment)
 
         return result_path
 
+    @api.multi
+    def _get_conversion_pool(self):
+        """Return the pool of LibreOffice workers to use for conversions or
+        None if each conversion has to run its own command
+        """
+        get_param = self.env['ir.config_parameter'].get_param
+        size = int(get_param('py3o.conversion_pool_size', 0))
+        if size <= 0:
+            return None
+        if not libreoffice_pool.is_available():
+            logger.warning(
+                'py3o.conversion_pool_size is set but the python uno module '
+                'is not available. Falling back to the conversion command.')
+            return None
+        return libreoffice_pool.get_pool(
+            get_param('py3o.conversion_command', 'libreoffice'),
+            size,
+            max_jobs=int(get_param('py3o.conversion_pool_max_jobs', 100)),
+            timeout=int(get_param('py3o.conversion_pool_timeout', 120)),
+        )
+
     @api.multi
     def _convert_single_report(self, result_path, model_instance, data):
         """Run a command to convert to our target format"""
         filetype = self.ir_actions_report_xml_id.py3o_filetype
-        if not Formats().get_format(filetype).native:
-            command = self._convert_single_report_cmd(
-                result_path, model_instance, data,
-            )
-            logger.debug('Running command %s', command)
-            output = subprocess.check_output(
-                command, cwd=os.path.dirname(result_path),
-            )
-            logger.debug('Output was %s', output)
+        fformat = Formats().get_format(filetype)
+        if fformat.native:
+            return result_path
+        pool = self._get_conversion_pool()
+        if pool:
+            logger.debug('Converting %s with the LibreOffice pool',
+                         result_path)
+            converted_path = pool.convert(
+                result_path, filetype, fformat.odfname)
             self._cleanup_tempfiles([result_path])
-            result_path, result_filename = os.path.split(result_path)
-            result_path = os.path.join(
-                result_path, '%s.%s' % (
-                    os.path.splitext(result_filename)[0], filetype
-                )
+            return converted_path
+        command = self._convert_single_report_cmd(
+            result_path, model_instance, data,
+        )
+        logger.debug('Running command %s', command)
+        output = subprocess.check_output(
+            command, cwd=os.path.dirname(result_path),
+        )
+        logger.debug('Output was %s', output)
+        self._cleanup_tempfiles([result_path])
+        result_path, result_filename = os.path.split(result_path)
+        result_path = os.path.join(
+            result_path, '%s.%s' % (
+                os.path.splitext(result_filename)[0], filetype
             )
+        )
         return result_path
 
     @api.multi
@@ -301,6 +556,114 @@ class Py3oReport(models.TransientModel):
             result_path,
         ]
 
+    @api.multi
+    def _get_conversion_batch_size(self):
+        """Return the maximum number of documents converted by a single
+        conversion command, or 0 if the documents are converted one by one
+        """
+        self.ensure_one()
+        filetype = self.ir_actions_report_xml_id.py3o_filetype
+        if Formats().get_format(filetype).native:
+            return 0
+        if self._get_conversion_pool():
+            # pooled workers are already running
+            return 0
+        # batches are opt-in: they need a conversion command accepting
+        # several files
+        batch_size = int(self.env['ir.config_parameter'].get_param(
+            'py3o.conversion_batch_size', 1))
+        return batch_size if batch_size > 1 else 0
+
+    @api.multi
+    def _convert_reports_batch_cmd(self, results_path):
+        """Return a command list converting all the given files, suitable
+        for use in subprocess.call"""
+        return [
+            self.env['ir.config_parameter'].get_param(
+                'py3o.conversion_command', 'libreoffice',
+            ),
+            '--headless',
+            '--convert-to',
+            self.ir_actions_report_xml_id.py3o_filetype,
+        ] + results_path
+
+    @api.multi
+    def _convert_reports_batch(self, results_path):
+        """Convert the given files to our target format with as few commands
+        as possible and return the paths of the converted files, in the same
+        order.
+        """
+        self.ensure_one()
+        filetype = self.ir_actions_report_xml_id.py3o_filetype
+        # the converted files are written in the working directory of the
+        # command
+        by_directory = {}
+        for result_path in results_path:
+            by_directory.setdefault(
+                os.path.dirname(result_path), []).append(result_path)
+        converted_paths = [
+            '%s.%s' % (os.path.splitext(result_path)[0], filetype)
+            for result_path in results_path
+        ]
+        try:
+            for directory, paths in by_directory.items():
+                command = self._convert_reports_batch_cmd(paths)
+                logger.debug('Running command %s', command)
+                output = subprocess.check_output(command, cwd=directory)
+                logger.debug('Output was %s', output)
+            for converted_path in converted_paths:
+                if not os.path.exists(converted_path):
+                    raise UserError(_(
+                        'The conversion of the report to %s failed.') %
+                        filetype)
+        except Exception:
+            # the documents converted before the failure are removed too
+            self._cleanup_tempfiles([
+                converted_path for converted_path in converted_paths
+                if os.path.exists(converted_path)])
+            raise
+        finally:
+            self._cleanup_tempfiles(results_path)
+        return converted_paths
+
+    @api.multi
+    def _create_reports_batch_conversion(self, model_instances, data,
+                                         save_in_attachment, batch_size):
+        """Render the report of each record then convert the rendered
+        documents by batches of ``batch_size``. The returned paths are in the
+        same order as ``model_instances``.
+        """
+        self.ensure_one()
+        reports_path = []
+        todo = []
+        try:
+            for model_instance in model_instances:
+                if save_in_attachment and save_in_attachment[
+                        'loaded_documents'].get(model_instance.id):
+                    reports_path.append(self._get_or_create_single_report(
+                        model_instance, data, save_in_attachment))
+                else:
+                    todo.append(len(reports_path))
+                    reports_path.append(self.with_context(
+                        report_py3o_skip_conversion=True,
+                    )._create_single_report(
+                        model_instance, data, save_in_attachment))
+            for chunk in tools.split_every(batch_size, todo):
+                converted_paths = self._convert_reports_batch(
+                    [reports_path[i] for i in chunk])
+                for i, converted_path in zip(chunk, converted_paths):
+                    reports_path[i] = converted_path
+                    self._postprocess_report(
+                        converted_path, model_instances[i].id,
+                        save_in_attachment)
+        except Exception:
+            # the documents of the other batches are removed too
+            self._cleanup_tempfiles([
+                report_path for report_path in reports_path
+                if os.path.exists(report_path)])
+            raise
+        return reports_path
+
     @api.multi
     def _get_or_create_single_report(self, model_instance, data,
                                      save_in_attachment):
@@ -317,19 +680,121 @@ class Py3oReport(models.TransientModel):
         return self._create_single_report(
             model_instance, data, save_in_attachment)
 
+    @api.multi
+    def _get_render_concurrency(self, model_instances):
+        """Return the number of processes used to render the given records.
+        The records are always rendered by the current process unless Odoo
+        runs with prefork workers.
+        """
+        concurrency = int(self.env['ir.config_parameter'].get_param(
+            'py3o.render_concurrency', 1))
+        if getattr(threading.currentThread(), 'testing', False):
+            # the workers can't see the data of the test transaction
+            return 1
+        if odoo.evented or not tools.config['workers']:
+            # forking a multi-threaded process is unsafe
+            return 1
+        return max(min(concurrency, len(model_instances)), 1)
+
+    @api.multi
+    def _renders_in_process(self, concurrency):
+        """Return whether the records are read by the current transaction
+        when rendered with ``concurrency``, so prefetching them is useful
+        """
+        return concurrency <= 1
+
+    @api.multi
+    def _create_reports_parallel(self, model_instances, data,
+                                 save_in_attachment, concurrency):
+        """Render the report of each record in a pool of processes. The
+        returned paths are in the same order as ``model_instances``.
+
+        Since each process works with its own cursor, only committed data
+        is visible to the templates.
+        """
+        self.ensure_one()
+        reports_path = []
+        todo = []
+        for model_instance in model_instances:
+            if save_in_attachment and save_in_attachment[
+                    'loaded_documents'].get(model_instance.id):
+                reports_path.append(self._get_or_create_single_report(
+                    model_instance, data, save_in_attachment))
+            else:
+                reports_path.append(None)
+                todo.append(model_instance)
+        args = [
+            (self.env.cr.dbname, self.env.uid, dict(self.env.context),
+             self.ir_actions_report_xml_id.id, model_instance.id, data)
+            for model_instance in todo
+        ]
+        rendered = []
+        if args:
+            logger.debug('Rendering %d reports with %d processes',
+                         len(args), concurrency)
+            pool = multiprocessing.Pool(
+                min(concurrency, len(args)),
+                initializer=_init_render_worker)
+            error = None
+            try:
+                results = [
+                    pool.apply_async(_render_single_report_worker, (arg,))
+                    for arg in args
+                ]
+                pool.close()
+                # wait for all the workers, even after a failure, to know
+                # every file they rendered
+                for result in results:
+                    try:
+                        rendered.append(result.get())
+                    except Exception as e:
+                        error = error or e
+            except Exception:
+                pool.terminate()
+                self._cleanup_tempfiles(filter(None, reports_path) + rendered)
+                raise
+            finally:
+                pool.join()
+            if error is not None:
+                self._cleanup_tempfiles(filter(None, reports_path) + rendered)
+                logger.error(
+                    'Rendering of the report %s failed in a worker process:'
+                    '\n%s', self.ir_actions_report_xml_id.report_name,
+                    getattr(error, 'worker_traceback', error))
+                raise error
+        rendered = iter(rendered)
+        for i, model_instance in enumerate(model_instances):
+            if reports_path[i] is None:
+                reports_path[i] = next(rendered)
+                self._postprocess_report(
+                    reports_path[i], model_instance.id, save_in_attachment)
+        return reports_path
+
     @api.multi
     def _zip_results(self, reports_path):
+        """ Zip the reports. ``reports_path`` can be a generator yielding the
+        reports as they are generated.
+        """
         self.ensure_one()
         zfname_prefix = self.ir_actions_report_xml_id.name
         result_path = tempfile.mktemp(suffix="zip", prefix='py3o-zip-result')
-        with ZipFile(result_path, 'w', ZIP_DEFLATED) as zf:
-            cpt = 0
-            for report in reports_path:
-                fname = "%s_%d.%s" % (
-                    zfname_prefix, cpt, report.split('.')[-1])
-                zf.write(report, fname)
-
-                cpt += 1
+        try:
+            with ZipFile(result_path, 'w', ZIP_DEFLATED,
+                         allowZip64=True) as zf:
+                cpt = 0
+                for report in reports_path:
+                    ext = report.split('.')[-1]
+                    fname = "%s_%d.%s" % (zfname_prefix, cpt, ext)
+                    if ext.lower() in ZIP_STORED_EXTENSIONS:
+                        # compressing these formats again is a waste of time
+                        zf.write(report, fname, ZIP_STORED)
+                    else:
+                        zf.write(report, fname)
+                    cpt += 1
+        except Exception:
+            if os.path.exists(result_path):
+                self._cleanup_tempfiles([result_path])
+            raise
         return result_path
 
     @api.multi
@@ -345,6 +810,17 @@ class Py3oReport(models.TransientModel):
         else:
             return self._zip_results(reports_path), 'zip'
 
+    @api.model
+    def _iter_tempfiles(self, temporary_files):
+        """ Yield the given files, removing each of them once used, i.e. when
+        the next one is asked for or the iteration stops.
+        """
+        for temporary_file in temporary_files:
+            try:
+                yield temporary_file
+            finally:
+                self._cleanup_tempfiles([temporary_file])
+
     @api.model
     def _cleanup_tempfiles(self, temporary_files):
         # Manual cleanup of the temporary files
@@ -356,35 +832,69 @@ class Py3oReport(models.TransientModel):
                     'Error when trying to remove file %s' % temporary_file)
 
     @api.multi
-    def create_report(self, res_ids, data):
-        """ Override this function to handle our py3o report
+    def _create_report_file(self, res_ids, data):
+        """ Generate the report into a temporary file and return its path and
+        filetype. The caller is responsible for removing the file.
+
+        Both create_report and the web controller, which streams the file to
+        the browser, go through this method: override it to change the
+        generated documents.
         """
         model_instances = self.env[self.ir_actions_report_xml_id.model].browse(
             res_ids)
         save_in_attachment = self._check_attachment_use(
             res_ids, self.ir_actions_report_xml_id) or {}
         reports_path = []
-        if (
-                len(res_ids) > 1 and
-                self.ir_actions_report_xml_id.py3o_multi_in_one):
+        multi_in_one = len(res_ids) > 1 and \
+            self.ir_actions_report_xml_id.py3o_multi_in_one
+        # a single document is always rendered by the current process
+        concurrency = 1 if multi_in_one else \
+            self._get_render_concurrency(model_instances)
+        if self._renders_in_process(concurrency):
+            self._prefetch_records(model_instances.filtered(
+                lambda r: r.id not in save_in_attachment.get(
+                    'loaded_documents', {})))
+        if multi_in_one:
             reports_path.append(
                 self._create_single_report(
                     model_instances, data, save_in_attachment))
         else:
-            for model_instance in model_instances:
-                reports_path.append(
+            batch_size = len(res_ids) > 1 and \
+                self._get_conversion_batch_size()
+            if concurrency > 1:
+                reports_path = self._create_reports_parallel(
+                    model_instances, data, save_in_attachment, concurrency)
+            elif batch_size:
+                reports_path = self._create_reports_batch_conversion(
+                    model_instances, data, save_in_attachment, batch_size)
+            elif (len(model_instances) > 1 and
+                  self.ir_actions_report_xml_id.py3o_filetype !=
+                  formats.FORMAT_PDF):
+                # add each report to the zip as soon as it is generated,
+                # and remove it once added
+                return self._zip_results(self._iter_tempfiles(
                     self._get_or_create_single_report(
-                        model_instance, data, save_in_attachment))
+                        model_instance, data, save_in_attachment)
+                    for model_instance in model_instances
+                )), 'zip'
+            else:
+                for model_instance in model_instances:
+                    reports_path.append(
+                        self._get_or_create_single_report(
+                            model_instance, data, save_in_attachment))
 
         result_path, filetype = self._merge_results(reports_path)
-        reports_path.append(result_path)
-
-        # Here is a little joke about Odoo
-        # we do all the generation process using files to avoid memory
-        # consumption...
-        # ... but odoo wants the whole data in memory anyways :)
+        self._cleanup_tempfiles(set(reports_path) - {result_path})
+        return result_path, filetype
 
-        with open(result_path, 'r+b') as fd:
+    @api.multi
+    def create_report(self, res_ids, data):
+        """ Override this function to handle our py3o report
+        """
+        result_path, filetype = self._create_report_file(res_ids, data)
+        # render_report must return the whole data. The web controller
+        # streams the result file instead of calling this method.
+        with open(result_path, 'rb') as fd:
             res = fd.read()
-        self._cleanup_tempfiles(set(reports_path))
+        self._cleanup_tempfiles([result_path])
         return res, filetype
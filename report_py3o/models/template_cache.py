@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
+"""Per process cache of parsed py3o templates.
+
+``py3o.template.Template`` unzips the ODF document and parses its XML files
+when it is instantiated, then modifies the parsed trees when it is
+rendered. The cache keeps a parsed template that is never rendered and
+gives a copy of its trees to each rendering.
+
+The templates are cached by the sha256 digest of their content, so a
+template returned by any override of ``get_template`` is never confused
+with another one.
+
+Copying a parsed template relies on the attributes set by the constructor
+of ``py3o.template.Template`` (see requirements.txt for the versions it is
+tested with). When they are missing, each rendering parses the template
+again with the public constructor.
+"""
+from collections import OrderedDict
+from cStringIO import StringIO
+import copy
+import hashlib
+import logging
+import threading
+from zipfile import ZipFile
+
+logger = logging.getLogger(__name__)
+
+# the attributes of a py3o Template reset by CachedTemplate.new_template
+TEMPLATE_ATTRIBUTES = (
+    'template', 'infile', 'outputfilename', 'content_trees', 'tree_roots',
+    'images', 'output_streams',
+)
+
+try:
+    from py3o.template import Template
+    from py3o.template.helpers import Py3oConvertor
+except ImportError:
+    logger.debug('Cannot import py3o.template')
+
+
+class CachedTemplate(object):
+    """A parsed template and the data it was parsed from"""
+
+    def __init__(self, tmpl_data, tmpl_hash=None):
+        self.tmpl_data = tmpl_data
+        self._tmpl_hash = tmpl_hash
+        self._data_struct = None
+        self.prototype = Template(StringIO(tmpl_data), None,
+                                  escape_false=True)
+        self.copyable = all(
+            name in vars(self.prototype) for name in TEMPLATE_ATTRIBUTES)
+        if not self.copyable:
+            logger.warning(
+                'Unsupported version of py3o.template: the parsed templates '
+                'are not reused')
+        # the parsed trees are far bigger than the zipped document, count
+        # the size of the unzipped files
+        with ZipFile(StringIO(tmpl_data)) as infile:
+            self.size = len(tmpl_data) + sum(
+                info.file_size for info in infile.infolist()
+                if info.filename in Template.templated_files)
+
+    @property
+    def tmpl_hash(self):
+        """The sha256 digest of the template document"""
+        if self._tmpl_hash is None:
+            self._tmpl_hash = template_hash(self.tmpl_data)
+        return self._tmpl_hash
+
+    @property
+    def data_struct(self):
+        """The structure of the data used by the expressions of the
+        template, to extract from the parser context the data sent to a
+        fusion server
+        """
+        if self._data_struct is None:
+            template = self.prototype
+            expressions = template.get_all_user_python_expression()
+            py_expression = template.convert_py3o_to_python_ast(expressions)
+            self._data_struct = Py3oConvertor()(py_expression)
+        return self._data_struct
+
+    def new_template(self, out_stream):
+        """Return a template ready to be rendered into ``out_stream``"""
+        if not self.copyable:
+            return Template(StringIO(self.tmpl_data), out_stream,
+                            escape_false=True)
+        template = copy.copy(self.prototype)
+        template.template = StringIO(self.tmpl_data)
+        template.infile = ZipFile(template.template, 'r')
+        template.outputfilename = out_stream
+        template.content_trees = [
+            copy.deepcopy(tree) for tree in self.prototype.content_trees]
+        template.tree_roots = [
+            tree.getroot() for tree in template.content_trees]
+        template.images = {}
+        template.output_streams = []
+        return template
+
+
+def template_hash(tmpl_data):
+    """Return the sha256 digest of a template document"""
+    return hashlib.sha256(tmpl_data).hexdigest()
+
+
+class TemplateCache(object):
+    """LRU cache of :class:`CachedTemplate` bounded by their size"""
+
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous.size
+            if entry.size > self.max_size:
+                logger.debug('Template %s is too big to be cached', key)
+                return
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_size:
+                dummy, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+cache = TemplateCache()
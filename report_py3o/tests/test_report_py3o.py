@@ -9,13 +9,20 @@ import os
 import pkg_resources
 import shutil
 import tempfile
+import threading
 from contextlib import contextmanager
+from cStringIO import StringIO
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+from lxml import etree
 
 from odoo import tools
 from odoo.tests.common import TransactionCase
-from odoo.exceptions import ValidationError
+from odoo.exceptions import UserError, ValidationError
 
-from ..models.py3o_report import TemplateNotFound, format_multiline_value
+from ..models import libreoffice_pool, template_cache
+from ..models.py3o_report import TemplateNotFound, format_multiline_value, \
+    _init_render_worker, _render_single_report_worker
 from base64 import b64encode
 import logging
 
@@ -38,6 +45,65 @@ def temporary_copy(path):
         os.unlink(tmp_filename)
 
 
+@contextmanager
+def fake_libreoffice(load=None):
+    """Yield a command starting a process standing in for LibreOffice, and
+    the list of the workers started with it. The workers are driven through
+    a mocked UNO bridge, ``load`` replaces the loading of the documents.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    command = os.path.join(tmp_dir, 'soffice')
+    with open(command, 'w') as command_file:
+        command_file.write('#!/bin/sh\nexec sleep 600\n')
+    os.chmod(command, 0o755)
+    workers = []
+    worker_class = libreoffice_pool.LibreOfficeWorker
+    start = worker_class.start
+
+    def start_worker(worker):
+        start(worker)
+        # LibreOffice exits when its desktop is terminated
+        worker.desktop = mock.Mock()
+        worker.desktop.terminate.side_effect = worker.process.terminate
+        if load is not None:
+            worker.desktop.loadComponentFromURL.side_effect = load
+        workers.append(worker)
+
+    try:
+        with mock.patch.object(libreoffice_pool, 'uno') as uno, \
+                mock.patch.object(libreoffice_pool, 'PropertyValue',
+                                  mock.Mock, create=True), \
+                mock.patch.object(worker_class, 'start', autospec=True,
+                                  side_effect=start_worker):
+            uno.systemPathToFileUrl.side_effect = lambda path: 'file://' + path
+            yield command, workers
+    finally:
+        for worker in workers:
+            worker.stop()
+        shutil.rmtree(tmp_dir)
+
+
+class SynchronousPool(object):
+    """Stand-in for multiprocessing.Pool running the tasks in the current
+    process"""
+
+    def __init__(self, processes, initializer=None):
+        self.processes = processes
+
+    def apply_async(self, func, args):
+        result = mock.Mock()
+        try:
+            result.get.return_value = func(*args)
+        except Exception as e:
+            result.get.side_effect = e
+        return result
+
+    def close(self):
+        pass
+
+    terminate = join = close
+
+
 class TestReportPy3o(TransactionCase):
 
     def setUp(self):
@@ -101,6 +167,27 @@ class TestReportPy3o(TransactionCase):
             self.env.user.ids, self.report.report_name, {})
         self.assertEqual(('new content', self.report.py3o_filetype), res)
 
+    def test_check_attachment_use(self):
+        self.report.write({"attachment_use": True,
+                           "attachment": "object.login + '.txt'"})
+        users = self.env['res.users'].search([], limit=2)
+        self.env['ir.attachment'].create({
+            'name': users[0].login + '.txt',
+            'datas': base64.encodestring("saved content"),
+            'datas_fname': users[0].login + '.txt',
+            'res_model': users._name,
+            'res_id': users[0].id,
+        })
+        save_in_attachment = self.py3o_report._check_attachment_use(
+            users.ids, self.report)
+        # the stored document is loaded, the other one will be saved
+        self.assertEqual(
+            {users[0].id: "saved content"},
+            save_in_attachment['loaded_documents'])
+        self.assertNotIn(users[0].id, save_in_attachment)
+        self.assertEqual(users[1].login + '.txt',
+                         save_in_attachment[users[1].id])
+
     def test_report_post_process(self):
         """
         By default the post_process method is in charge to save the
@@ -200,3 +287,517 @@ class TestReportPy3o(TransactionCase):
     def test_escape_html_characters_format_multiline_value(self):
         self.assertEqual(Markup('&lt;&gt;<text:line-break/>&amp;test;'),
                          format_multiline_value('<>\n&test;'))
+
+    def test_conversion_pool(self):
+        self.report.py3o_filetype = 'pdf'
+        result_fd, result_path = tempfile.mkstemp(suffix='.odt')
+        os.close(result_fd)
+        pool = mock.Mock()
+        pool.convert.return_value = result_path[:-3] + 'pdf'
+        with mock.patch.object(libreoffice_pool, 'is_available',
+                               return_value=True), \
+                mock.patch.object(libreoffice_pool, 'get_pool',
+                                  return_value=pool) as get_pool:
+            self.env['ir.config_parameter'].set_param(
+                'py3o.conversion_pool_size', '2')
+            converted = self.py3o_report._convert_single_report(
+                result_path, self.env.user, {})
+        self.assertEqual(result_path[:-3] + 'pdf', converted)
+        get_pool.assert_called_once_with(
+            'libreoffice', 2, max_jobs=100, timeout=120)
+        pool.convert.assert_called_once_with(
+            result_path, 'pdf', 'writer_pdf_Export')
+        # the rendered document is removed once converted
+        self.assertFalse(os.path.exists(result_path))
+
+    def test_conversion_pool_max_jobs(self):
+        with fake_libreoffice() as (command, workers):
+            pool = libreoffice_pool.LibreOfficePool(command, 1, max_jobs=2)
+            for dummy in range(3):
+                self.assertEqual(
+                    '/tmp/document.pdf',
+                    pool.convert('/tmp/document.odt', 'pdf',
+                                 'writer_pdf_Export'))
+            # the worker is restarted after 2 conversions
+            self.assertEqual(2, len(workers))
+            self.assertFalse(workers[0].is_alive())
+            self.assertTrue(workers[1].is_alive())
+            pool.shutdown()
+            self.assertFalse(workers[1].is_alive())
+            self.assertEqual(0, pool._count)
+
+    def test_conversion_pool_timeout(self):
+        workers = []
+
+        def load(*args):
+            # the conversion lasts until the worker is killed
+            for dummy in range(100):
+                if not workers[0].is_alive():
+                    break
+                threading.Event().wait(0.1)
+            raise RuntimeError('LibreOffice disposed')
+
+        with fake_libreoffice(load=load) as (command, started):
+            workers = started
+            pool = libreoffice_pool.LibreOfficePool(command, 1, timeout=1)
+            with self.assertRaises(libreoffice_pool.LibreOfficePoolError) \
+                    as e:
+                pool.convert('/tmp/document.odt', 'pdf', 'writer_pdf_Export')
+            self.assertIn('killed after 1 seconds', str(e.exception))
+            # the killed worker is removed from the pool
+            self.assertFalse(workers[0].is_alive())
+            self.assertEqual(0, pool._count)
+
+    def test_conversion_pool_replaced(self):
+        with fake_libreoffice() as (command, workers):
+            try:
+                pool = libreoffice_pool.get_pool(command, 2)
+                busy = pool._acquire()
+                idle = pool._acquire()
+                pool._release(idle)
+                # new settings replace the pool
+                self.assertIsNot(
+                    pool, libreoffice_pool.get_pool(command, 2, max_jobs=5))
+                self.assertFalse(idle.is_alive())
+                # its busy workers are stopped once released
+                self.assertTrue(busy.is_alive())
+                pool._release(busy)
+                self.assertFalse(busy.is_alive())
+                self.assertEqual(0, pool._count)
+            finally:
+                libreoffice_pool.shutdown_pools()
+
+    def test_render_concurrency(self):
+        self.env['ir.config_parameter'].set_param(
+            'py3o.render_concurrency', '4')
+        users = self.env['res.users'].search([], limit=2)
+        # the workers would not see the test transaction
+        self.assertEqual(
+            1, self.py3o_report._get_render_concurrency(users))
+        with mock.patch('odoo.addons.report_py3o.models.py3o_report.'
+                        'threading') as threading:
+            threading.currentThread.return_value.testing = False
+            # the records are rendered in process by a threaded server
+            with mock.patch.dict(tools.config.options, {'workers': 0}):
+                self.assertEqual(
+                    1, self.py3o_report._get_render_concurrency(users))
+            with mock.patch.dict(tools.config.options, {'workers': 2}):
+                self.assertEqual(
+                    2, self.py3o_report._get_render_concurrency(users))
+                self.assertEqual(
+                    1, self.py3o_report._get_render_concurrency(
+                        self.env.user))
+
+    def test_multi_in_one_prefetch(self):
+        self.report.py3o_multi_in_one = True
+        users = self.env['res.users'].search([], limit=2)
+        py3o_report_class = self.py3o_report.__class__
+        result_fd, result_path = tempfile.mkstemp(suffix='.odt')
+        os.close(result_fd)
+        with mock.patch.object(
+                py3o_report_class, '_get_render_concurrency',
+                return_value=2) as concurrency, \
+                mock.patch.object(
+                    py3o_report_class, '_prefetch_records') as prefetch, \
+                mock.patch.object(
+                    py3o_report_class, '_create_single_report',
+                    return_value=result_path) as create_single_report:
+            self.assertEqual(
+                (result_path, self.report.py3o_filetype),
+                self.py3o_report._create_report_file(users.ids, {}))
+            self.py3o_report._cleanup_tempfiles([result_path])
+        # the single document is rendered in process, with the prefetch
+        self.assertFalse(concurrency.called)
+        self.assertEqual(1, create_single_report.call_count)
+        self.assertEqual(users, prefetch.call_args[0][0])
+
+    def test_render_worker(self):
+        module = 'odoo.addons.report_py3o.models.py3o_report.'
+        with mock.patch(module + 'signal') as signal, \
+                mock.patch('odoo.sql_db._Pool'), \
+                mock.patch(module + 'libreoffice_pool.reset_after_fork'), \
+                mock.patch(module + 'multiprocessing.util.Finalize'):
+            _init_render_worker()
+        # the workers are stopped by the termination of the pool
+        signal.signal.assert_has_calls([
+            mock.call(signal.SIGTERM, signal.SIG_DFL),
+            mock.call(signal.SIGINT, signal.SIG_DFL),
+        ])
+        # the parent process gets the traceback of a failure
+        with mock.patch('odoo.sql_db.db_connect',
+                        side_effect=IOError('Connection failed')):
+            with self.assertRaises(IOError) as e:
+                _render_single_report_worker((
+                    self.env.cr.dbname, self.env.uid, {}, self.report.id,
+                    self.env.uid, {}))
+        self.assertIn('Connection failed', e.exception.worker_traceback)
+        self.assertIn('db_connect', e.exception.worker_traceback)
+
+    @tools.misc.mute_logger('odoo.addons.report_py3o.models.py3o_report')
+    def test_parallel_rendering(self):
+        users = self.env['res.users'].search([], limit=3)
+        rendered = {}
+        failing = []
+
+        def render(args):
+            if args[4] in failing:
+                raise IOError('Rendering failed')
+            result_fd, result_path = tempfile.mkstemp(suffix='.odt')
+            os.close(result_fd)
+            # the record rendered by each worker
+            rendered[result_path] = args[4]
+            return result_path
+
+        module = 'odoo.addons.report_py3o.models.py3o_report.'
+        with mock.patch(module + 'multiprocessing.Pool', SynchronousPool), \
+                mock.patch(module + '_render_single_report_worker',
+                           side_effect=render), \
+                mock.patch.object(self.py3o_report.__class__,
+                                  '_postprocess_report') as postprocess:
+            reports_path = self.py3o_report._create_reports_parallel(
+                users, {}, {}, 2)
+            try:
+                # the paths are in the order of the records, and the
+                # attachments are saved by the parent process
+                self.assertEqual(
+                    users.ids, [rendered[path] for path in reports_path])
+                self.assertEqual(
+                    [mock.call(path, rendered[path], {})
+                     for path in reports_path],
+                    postprocess.call_args_list)
+            finally:
+                self.py3o_report._cleanup_tempfiles(reports_path)
+            # the documents rendered before a failure are removed
+            rendered.clear()
+            postprocess.reset_mock()
+            failing.append(users[1].id)
+            with self.assertRaises(IOError):
+                self.py3o_report._create_reports_parallel(users, {}, {}, 2)
+            self.assertFalse(postprocess.called)
+            self.assertEqual(len(users) - 1, len(rendered))
+            for path in rendered:
+                self.assertFalse(os.path.exists(path))
+
+    def test_template_cache(self):
+        template_cache.cache.clear()
+        with mock.patch.object(
+                template_cache, 'CachedTemplate',
+                wraps=template_cache.CachedTemplate) as cached_template:
+            for dummy in range(3):
+                self.report.render_report(
+                    self.env.user.ids, self.report.report_name, {})
+            # the template is parsed once for all the renderings
+            self.assertEqual(1, cached_template.call_count)
+            self.assertEqual(1, len(template_cache.cache))
+            # and parsed again once modified
+            tmpl_data = self.py3o_report.get_template(self.env.user)
+            self.report.py3o_template_id = self.env['py3o.template'].create({
+                'name': 'test_template',
+                'py3o_template_data': b64encode(
+                    self._other_template(tmpl_data)),
+                'filetype': 'odt',
+            })
+            self.report.render_report(
+                self.env.user.ids, self.report.report_name, {})
+            self.assertEqual(2, cached_template.call_count)
+
+    def _other_template(self, tmpl_data):
+        """ Return a copy of the template document with another content """
+        result = StringIO()
+        with ZipFile(StringIO(tmpl_data)) as template, \
+                ZipFile(result, 'w') as other_template:
+            for info in template.infolist():
+                other_template.writestr(info, template.read(info.filename))
+            other_template.writestr('other.txt', 'other template')
+        return result.getvalue()
+
+    def test_template_cache_per_record(self):
+        template_cache.cache.clear()
+        users = self.env['res.users'].search([], limit=2)
+        tmpl_data = self.py3o_report.get_template(users[0])
+        templates = {
+            users[0].id: tmpl_data,
+            users[1].id: self._other_template(tmpl_data),
+        }
+        # get_template may return a template depending on the record
+        with mock.patch.object(
+                self.py3o_report.__class__, 'get_template', autospec=True,
+                side_effect=lambda report, record: templates[record.id]):
+            for user in users + users:
+                cached_template = self.py3o_report._get_cached_template(user)
+                self.assertEqual(
+                    templates[user.id], cached_template.tmpl_data)
+                with tempfile.TemporaryFile() as out_stream:
+                    self.py3o_report._render_single_report(
+                        user, {}, out_stream)
+                    out_stream.seek(0)
+                    with ZipFile(out_stream) as document:
+                        self.assertEqual(
+                            user == users[1],
+                            'other.txt' in document.namelist())
+        self.assertEqual(2, len(template_cache.cache))
+
+    def test_template_copy(self):
+        tmpl_data = self.py3o_report.get_template(self.env.user)
+        cached_template = template_cache.CachedTemplate(tmpl_data)
+        # the installed py3o.template is supported
+        self.assertTrue(cached_template.copyable)
+        out_stream = StringIO()
+        template = cached_template.new_template(out_stream)
+        parsed_template = template_cache.Template(
+            StringIO(tmpl_data), out_stream, escape_false=True)
+        # the copy has the state of a newly parsed template
+        self.assertEqual(sorted(vars(parsed_template)), sorted(vars(template)))
+        self.assertEqual(
+            [etree.tostring(tree) for tree in parsed_template.content_trees],
+            [etree.tostring(tree) for tree in template.content_trees])
+        for tree, prototype_tree in zip(
+                template.content_trees,
+                cached_template.prototype.content_trees):
+            self.assertIsNot(tree, prototype_tree)
+        # other versions parse the template for each rendering
+        cached_template.copyable = False
+        with mock.patch.object(template_cache, 'Template') as new_template:
+            template = cached_template.new_template(out_stream)
+        self.assertIs(new_template.return_value, template)
+
+    def test_template_cache_eviction(self):
+        cache = template_cache.TemplateCache(max_size=10)
+        for key in ('a', 'b', 'c'):
+            cache.set(key, mock.Mock(size=4))
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('a'))
+        self.assertTrue(cache.get('b'))
+        cache.set('d', mock.Mock(size=4))
+        # 'c' is the least recently used entry
+        self.assertIsNone(cache.get('c'))
+        self.assertTrue(cache.get('b'))
+        cache.set('e', mock.Mock(size=11))
+        self.assertIsNone(cache.get('e'))
+
+    def test_conversion_batch_size(self):
+        self.report.py3o_filetype = 'pdf'
+        # the documents are converted one by one unless enabled
+        self.assertEqual(0, self.py3o_report._get_conversion_batch_size())
+        self.env['ir.config_parameter'].set_param(
+            'py3o.conversion_batch_size', '3')
+        self.assertEqual(3, self.py3o_report._get_conversion_batch_size())
+
+    def test_conversion_batch(self):
+        self.report.py3o_filetype = 'pdf'
+        results_path = []
+        for dummy in range(3):
+            result_fd, result_path = tempfile.mkstemp(suffix='.odt')
+            os.close(result_fd)
+            results_path.append(result_path)
+        expected_paths = [path[:-3] + 'pdf' for path in results_path]
+
+        def convert(command, cwd):
+            for path in command[4:]:
+                open(path[:-3] + 'pdf', 'w').close()
+            return ''
+
+        with mock.patch('subprocess.check_output',
+                        side_effect=convert) as check_output:
+            converted = self.py3o_report._convert_reports_batch(
+                results_path)
+        # all the documents are converted by the same command
+        check_output.assert_called_once_with(
+            ['libreoffice', '--headless', '--convert-to', 'pdf'] +
+            results_path,
+            cwd=os.path.dirname(results_path[0]))
+        self.assertEqual(expected_paths, converted)
+        for result_path in results_path:
+            self.assertFalse(os.path.exists(result_path))
+        self.py3o_report._cleanup_tempfiles(converted)
+
+    def test_conversion_batch_failure(self):
+        self.report.py3o_filetype = 'pdf'
+
+        def convert(command, cwd):
+            # only the first document is converted
+            open(command[4][:-3] + 'pdf', 'w').close()
+            return ''
+
+        for side_effect, exception in [(convert, UserError),
+                                       (OSError, OSError)]:
+            results_path = []
+            for dummy in range(2):
+                result_fd, result_path = tempfile.mkstemp(suffix='.odt')
+                os.close(result_fd)
+                results_path.append(result_path)
+            with mock.patch('subprocess.check_output',
+                            side_effect=side_effect):
+                with self.assertRaises(exception):
+                    self.py3o_report._convert_reports_batch(results_path)
+            # the documents and the partial conversions are removed
+            for result_path in results_path:
+                self.assertFalse(os.path.exists(result_path))
+                self.assertFalse(os.path.exists(result_path[:-3] + 'pdf'))
+
+    def test_create_report_file(self):
+        result_path, filetype = self.py3o_report._create_report_file(
+            self.env.user.ids, {})
+        try:
+            self.assertTrue(os.path.isfile(result_path))
+            self.assertEqual(self.report.py3o_filetype, filetype)
+        finally:
+            self.py3o_report._cleanup_tempfiles([result_path])
+
+    def test_create_report_file_override(self):
+        py3o_report_class = self.py3o_report.__class__
+        create_report_file = py3o_report_class._create_report_file
+
+        def override(report, res_ids, data):
+            result_path, filetype = create_report_file(report, res_ids, data)
+            with open(result_path, 'ab') as result_file:
+                result_file.write('custom content')
+            return result_path, filetype
+
+        # the documents returned to the web controller and by create_report
+        # go through the same method
+        with mock.patch.object(
+                py3o_report_class, '_create_report_file', autospec=True,
+                side_effect=override):
+            res, filetype = self.py3o_report.create_report(
+                self.env.user.ids, {})
+        self.assertTrue(res.endswith('custom content'))
+        self.assertEqual(self.report.py3o_filetype, filetype)
+
+    def test_zip_results(self):
+        reports_path = []
+        for ext in ('odt', 'txt'):
+            report_fd, report_path = tempfile.mkstemp(suffix='.' + ext)
+            with os.fdopen(report_fd, 'w') as report_file:
+                report_file.write('test result ' * 100)
+            reports_path.append(report_path)
+        result_path = self.py3o_report._zip_results(
+            self.py3o_report._iter_tempfiles(reports_path))
+        try:
+            with ZipFile(result_path) as zf:
+                infos = zf.infolist()
+                self.assertEqual(
+                    ['%s_0.odt' % self.report.name,
+                     '%s_1.txt' % self.report.name],
+                    [info.filename for info in infos])
+                # odf documents are already compressed
+                self.assertEqual(ZIP_STORED, infos[0].compress_type)
+                self.assertEqual(ZIP_DEFLATED, infos[1].compress_type)
+            # the zipped reports are removed by the iteration
+            for report_path in reports_path:
+                self.assertFalse(os.path.exists(report_path))
+        finally:
+            self.py3o_report._cleanup_tempfiles([result_path])
+        # but kept when zipped directly
+        report_fd, report_path = tempfile.mkstemp(suffix='.txt')
+        os.close(report_fd)
+        result_path = self.py3o_report._zip_results([report_path])
+        self.assertTrue(os.path.exists(report_path))
+        self.py3o_report._cleanup_tempfiles([report_path, result_path])
+
+    def test_prefetch(self):
+        with self.assertRaises(ValidationError):
+            self.report.py3o_prefetch = 'partner_id.unknown_field'
+        with self.assertRaises(ValidationError):
+            self.report.py3o_prefetch = 'name.id'
+        self.report.py3o_prefetch = 'partner_id.country_id.name\n\n' \
+            'company_id.name'
+        self.assertEqual(
+            ['partner_id.country_id.name', 'company_id.name'],
+            self.report._get_py3o_prefetch_paths())
+        users = self.env['res.users'].search([])
+        users.invalidate_cache()
+        self.py3o_report._prefetch_records(users)
+        # the countries of the partners of all the users are in the cache
+        partners = users.mapped('partner_id')
+        country_cache = self.env.cache[partners._fields['country_id']]
+        self.assertTrue(all(
+            partner_id in country_cache for partner_id in partners.ids))
+        res = self.report.render_report(
+            self.env.user.ids, self.report.report_name, {})
+        self.assertTrue(res)
+
+    def test_extender_functions_cache(self):
+        py3o_report = self.env['py3o.report']
+        py3o_report.clear_caches()
+        report_xml_class = self.report.__class__
+        with mock.patch.object(
+                report_xml_class, 'get_external_id',
+                autospec=True,
+                side_effect=report_xml_class.get_external_id) as xml_ids:
+            extenders = py3o_report._get_extender_functions(self.report.id)
+            self.assertEqual(
+                extenders,
+                py3o_report._get_extender_functions(self.report.id))
+            self.assertEqual(1, xml_ids.call_count)
+            # a new xml id for the report invalidates the cache
+            self.env['ir.model.data'].create({
+                'module': 'report_py3o',
+                'name': 'test_report_xml_id',
+                'model': self.report._name,
+                'res_id': self.report.id,
+            })
+            py3o_report._get_extender_functions(self.report.id)
+            self.assertEqual(2, xml_ids.call_count)
+        # the xml ids of other reports leave the caches alone
+        qweb_report = self.env['ir.actions.report.xml'].create({
+            'name': 'Test report',
+            'model': 'res.users',
+            'report_name': 'report_py3o.test_qweb_report',
+            'report_type': 'qweb-pdf',
+        })
+        with mock.patch.object(
+                self.env['ir.model.data'].__class__,
+                'clear_caches') as clear_caches:
+            xml_id = self.env['ir.model.data'].create({
+                'module': 'report_py3o',
+                'name': 'test_qweb_report_xml_id',
+                'model': qweb_report._name,
+                'res_id': qweb_report.id,
+            })
+            xml_id.write({'res_id': qweb_report.id})
+            xml_id.unlink()
+            self.assertFalse(clear_caches.called)
+
+    def test_spooled_rendering(self):
+        self.env['ir.config_parameter'].set_param('py3o.spool_max_size', '1')
+        with tempfile.TemporaryFile() as result_file:
+            out_stream = self.py3o_report._new_spooled_file(result_file)
+            out_stream.write('x' * 1024)
+            # nothing is written to the disk under the threshold
+            self.assertEqual(0, os.fstat(result_file.fileno()).st_size)
+            out_stream.write_result()
+            self.assertEqual(1024, os.fstat(result_file.fileno()).st_size)
+        with tempfile.TemporaryFile() as result_file:
+            out_stream = self.py3o_report._new_spooled_file(result_file)
+            with mock.patch('tempfile.TemporaryFile') as temporary_file:
+                out_stream.write('x' * (1024 * 1024 + 1))
+            # over it, the document goes directly to the result file
+            self.assertFalse(temporary_file.called)
+            out_stream.write_result()
+            self.assertEqual(
+                1024 * 1024 + 1, os.fstat(result_file.fileno()).st_size)
+        self.report.attachment = "object.name + '.odt'"
+        save_in_attachment = self.py3o_report._check_attachment_use(
+            self.env.user.ids, self.report)
+        with mock.patch.object(
+                self.py3o_report.__class__, '_postprocess_report') as \
+                postprocess:
+            result_path = self.py3o_report._create_single_report(
+                self.env.user, {}, save_in_attachment)
+        try:
+            attachment = self.env['ir.attachment'].search([
+                ('res_model', '=', self.env.user._name),
+                ('res_id', '=', self.env.user.id),
+                ('datas_fname', '=', self.env.user.name + '.odt'),
+            ])
+            if self.report.py3o_filetype == 'odt':
+                # the attachment is saved from the rendered document
+                self.assertFalse(postprocess.called)
+                with open(result_path, 'rb') as result_file:
+                    self.assertEqual(
+                        result_file.read(), b64decode(attachment.datas))
+            else:
+                self.assertTrue(postprocess.called)
+        finally:
+            self.py3o_report._cleanup_tempfiles([result_path])
@@ -4,7 +4,7 @@
 {
     'name': 'Py3o Report Engine - Fusion server support',
     'summary': 'Let the fusion server handle format conversion.',
-    'version': '10.0.1.0.0',
+    'version': '10.0.1.2.0',
     'category': 'Reporting',
     'license': 'AGPL-3',
     'author': 'XCG Consulting,'
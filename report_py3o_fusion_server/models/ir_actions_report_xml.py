@@ -5,6 +5,7 @@
 import logging
 from openerp import _, api, fields, models
 from odoo.exceptions import ValidationError
+from . import server_pool
 
 logger = logging.getLogger(__name__)
 
@@ -39,7 +40,28 @@ class IrActionsReportXml(models.Model):
     py3o_server_id = fields.Many2one(
         "py3o.server",
         "Fusion Server")
+    py3o_server_ids = fields.Many2many(
+        "py3o.server",
+        string="Additional Fusion Servers",
+        help="The documents are rendered by the Fusion Server and these "
+             "servers, the requests being spread among them.")
+    py3o_server_balancing = fields.Selection([
+        (server_pool.ROUND_ROBIN, "Round Robin"),
+        (server_pool.LEAST_OUTSTANDING, "Least Outstanding Requests"),
+    ], "Load Balancing", default=server_pool.ROUND_ROBIN,
+        help="Round Robin sends the requests to each server in turn. "
+             "Least Outstanding Requests sends them to the server with the "
+             "fewest requests in progress.")
     pdf_options_id = fields.Many2one(
         'py3o.pdf.options', string='PDF Options', ondelete='restrict',
         help="PDF options can be set per report, but also per Py3o Server. "
         "If both are defined, the options on the report are used.")
+
+    @api.multi
+    def _get_py3o_servers(self):
+        """ Return the active servers which render the documents of this
+        report, the main one first.
+        """
+        self.ensure_one()
+        servers = self.py3o_server_id | self.py3o_server_ids
+        return servers.filtered('is_active') or self.py3o_server_id
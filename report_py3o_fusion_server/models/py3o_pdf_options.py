@@ -3,8 +3,9 @@
 # @author: Alexis de Lattre <alexis.delattre@akretion.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from odoo import api, fields, models, _
+from odoo import api, fields, models, tools, _
 from odoo.exceptions import ValidationError
+import json
 import logging
 logger = logging.getLogger(__name__)
 
@@ -226,6 +227,31 @@ class Py3oPdfOptions(models.Model):
             self.encrypt = False
             self.restrict_permissions = False
 
+    @api.multi
+    def write(self, vals):
+        res = super(Py3oPdfOptions, self).write(vals)
+        self.clear_caches()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super(Py3oPdfOptions, self).unlink()
+        self.clear_caches()
+        return res
+
+    @api.multi
+    def _get_libreoffice_options_payload(self):
+        """ Return the options encoded in JSON, as sent to the fusion server.
+        They are computed once until the options are modified.
+        """
+        self.ensure_one()
+        return self._libreoffice_options_payload(self.id)
+
+    @api.model
+    @tools.ormcache('options_id')
+    def _libreoffice_options_payload(self, options_id):
+        return json.dumps(self.browse(options_id).odoo2libreoffice_options())
+
     def odoo2libreoffice_options(self):
         self.ensure_one()
         options = {}
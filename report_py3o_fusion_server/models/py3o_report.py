@@ -3,109 +3,539 @@
 # © 2016 ACSONE SA/NV
 # © 2017 Therp BV <http://therp.nl>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
-import json
 import logging
 import os
-import requests
+import shutil
 import tempfile
-from datetime import datetime
+import threading
+import time
 from contextlib import closing
-from openerp import _, api, models
+from zipfile import ZipFile
+from multiprocessing.pool import ThreadPool
+from openerp import _, api, models, tools
 from openerp.exceptions import UserError
-from StringIO import StringIO
+
+from . import serializer, server_pool
 
 logger = logging.getLogger(__name__)
 
+# answers of a server that can't handle the request, which is sent to the
+# next one
+UNAVAILABLE_STATUS = (502, 503, 504)
+
 try:
-    from py3o.template import Template
-    from py3o.template.helpers import Py3oConvertor
+    from requests.exceptions import RequestException
 except ImportError:
-    logger.debug('Cannot import py3o.template')
+    logger.debug('Cannot import requests')
+
+
+class FusionRequest(object):
+    """ A rendering request for the fusion server. It is prepared with the
+    ORM, then sent without it, possibly from another thread.
+
+    The request goes to the first of ``endpoints`` chosen by the
+    ``balancing`` policy, then to the next ones if it can't be delivered.
+    """
+
+    def __init__(self, endpoints, fields, result_path, tmpl_data=None,
+                 tmpl_path=None, report_name=None,
+                 balancing=server_pool.ROUND_ROBIN, tmpl_hash=None,
+                 json_fields=None, json_serializer=None):
+        self.endpoints = endpoints
+        self.fields = fields
+        # the fields encoded in JSON when the request is sent
+        self.json_fields = json_fields or {}
+        self.json_serializer = json_serializer or serializer.get_serializer()
+        self._encoded_json_fields = None
+        self.result_path = result_path
+        # the template is either given or read from a file when sent
+        self.tmpl_data = tmpl_data
+        self.tmpl_path = tmpl_path
+        # digest of a template the servers may already store
+        self.tmpl_hash = tmpl_hash
+        self.report_name = report_name
+        self.balancing = balancing
+
+    def _post_form(self, endpoint, fields, files=None):
+        if endpoint.stream_upload:
+            body = serializer.MultipartBody(
+                fields, self.json_fields, files, self.json_serializer)
+            try:
+                return endpoint.session.post(
+                    endpoint.url, data=body,
+                    headers={'Content-Type': body.content_type},
+                    timeout=endpoint.timeout, stream=True)
+            finally:
+                body.close()
+        if self._encoded_json_fields is None:
+            self._encoded_json_fields = dict(
+                (name, self.json_serializer.dumps(value))
+                for name, value in self.json_fields.items())
+        fields = dict(fields, **self._encoded_json_fields)
+        return endpoint.session.post(
+            endpoint.url, data=fields, files=files,
+            timeout=endpoint.timeout, stream=True)
+
+    def _post(self, endpoint, tmpl_data):
+        fields = dict(self.fields, **endpoint.fields)
+        files = {'tmpl_file': tmpl_data}
+        dedup = endpoint.template_dedup and self.tmpl_hash
+        if dedup:
+            fields['tmpl_hash'] = self.tmpl_hash
+            if endpoint.knows_template(self.tmpl_hash):
+                r = self._post_form(endpoint, fields)
+                if r.status_code == 200 or \
+                        r.status_code in UNAVAILABLE_STATUS:
+                    # an unavailable server doesn't get the template: the
+                    # request goes to the next one
+                    return r
+                # the server lost the template or doesn't store templates:
+                # upload it
+                logger.debug('Template %s unknown to %s',
+                             self.tmpl_hash, endpoint.url)
+                r.close()
+                endpoint.set_template_known(self.tmpl_hash, False)
+        r = self._post_form(endpoint, fields, files)
+        if dedup and r.status_code == 200:
+            endpoint.set_template_known(self.tmpl_hash)
+        return r
+
+    def _write_result(self, response, endpoint):
+        with open(self.result_path, 'w+') as fd:
+            for chunk in response.iter_content(endpoint.chunk_size):
+                fd.write(chunk)
+
+    def send(self):
+        """ Send the request and write the rendered document into
+        ``result_path``. Return the error message of the server, if any.
+        """
+        tmpl_data = self.tmpl_data
+        if tmpl_data is None:
+            with open(self.tmpl_path, 'rb') as tmpl_file:
+                tmpl_data = tmpl_file.read()
+        filetype = self.fields['targetformat']
+        error = None
+        for endpoint in server_pool.order_endpoints(
+                self.endpoints, self.balancing):
+            if endpoint.stats.needs_check() and \
+                    not endpoint.check_health():
+                continue
+            logger.info(
+                'Connecting to %s to convert report %s to %s',
+                endpoint.url, self.report_name, filetype)
+            start_chrono = endpoint.acquire()
+            failed = True
+            try:
+                r = self._post(endpoint, tmpl_data)
+                with closing(r):
+                    if r.status_code in UNAVAILABLE_STATUS:
+                        error = r.text
+                        logger.warning(
+                            'Py3o fusion server %s unavailable: %s',
+                            endpoint.url, error)
+                        continue
+                    # a server failing every request must be ejected
+                    failed = r.status_code >= 500
+                    if r.status_code != 200:
+                        logger.error('Py3o fusion server error: %s', r.text)
+                        return r.text
+                    self._write_result(r, endpoint)
+            except RequestException as e:
+                error = str(e)
+                logger.warning(
+                    'Py3o fusion server %s unreachable: %s',
+                    endpoint.url, error)
+                continue
+            finally:
+                endpoint.release(start_chrono, failed=failed)
+            logger.info(
+                'Report %s converted to %s in %s seconds',
+                self.report_name, filetype, time.time() - start_chrono)
+            return None
+        return error or 'No Py3o server available'
+
+
+class FusionBatchRequest(FusionRequest):
+    """ A request rendering a document for each of the datadicts of its
+    ``datadicts`` field with the same template.
+
+    The server answers with a zip file holding the documents named after the
+    index of their datadict, written into ``result_paths``. When the
+    ``merge`` field is set, it answers with the merged documents instead,
+    written into ``result_path``.
+    """
+
+    def __init__(self, endpoints, fields, result_path, result_paths=None,
+                 **kwargs):
+        super(FusionBatchRequest, self).__init__(
+            endpoints, fields, result_path, **kwargs)
+        self.result_paths = result_paths
+
+    def _write_result(self, response, endpoint):
+        super(FusionBatchRequest, self)._write_result(response, endpoint)
+        if self.fields.get('merge'):
+            return
+        try:
+            with ZipFile(self.result_path) as zf:
+                names = sorted(
+                    zf.namelist(), key=lambda name: int(name.split('.')[0]))
+                if len(names) != len(self.result_paths):
+                    raise ValueError(
+                        'Py3o fusion server %s returned %d documents '
+                        'instead of %d' % (
+                            endpoint.url, len(names), len(self.result_paths)))
+                for name, result_path in zip(names, self.result_paths):
+                    with closing(zf.open(name)) as document, \
+                            open(result_path, 'wb') as fd:
+                        shutil.copyfileobj(document, fd)
+        finally:
+            os.unlink(self.result_path)
+
+
+def _send_fusion_request(fusion_request):
+    return fusion_request.send()
+
+
+# the servers resolved for the reports generated by the current thread, by
+# database and py3o.report id, held while their records are rendered
+_held_endpoints = threading.local()
+
+
+def _get_held_endpoints():
+    if not hasattr(_held_endpoints, 'reports'):
+        _held_endpoints.reports = {}
+    return _held_endpoints.reports
 
 
 class Py3oReport(models.TransientModel):
     _inherit = 'py3o.report'
 
     @api.multi
-    def _create_single_report(self, model_instance, data, save_in_attachment):
-        """ This function to generate our py3o report
+    def _get_conversion_batch_size(self):
+        report_xml = self.ir_actions_report_xml_id
+        if not report_xml.py3o_server_id:
+            return super(Py3oReport, self)._get_conversion_batch_size()
+        if report_xml.py3o_is_local_fusion:
+            # the fusion server converts the documents one by one
+            return 0
+        # number of datadicts sent in each request
+        batch_size = min(report_xml._get_py3o_servers().mapped('batch_size'))
+        return batch_size if batch_size > 1 else 0
+
+    @api.multi
+    def _get_render_concurrency(self, model_instances):
+        concurrency = self.env['ir.config_parameter'].get_param(
+            'py3o.fusion_concurrency')
+        if not self.ir_actions_report_xml_id.py3o_server_id or \
+                not concurrency:
+            return super(Py3oReport, self)._get_render_concurrency(
+                model_instances)
+        # the requests are prepared by the current transaction, then sent
+        # concurrently: this works in tests too
+        return max(min(int(concurrency), len(model_instances)), 1)
+
+    @api.multi
+    def _renders_in_process(self, concurrency):
+        if self.ir_actions_report_xml_id.py3o_server_id:
+            # the datadicts are always built by the current transaction
+            return True
+        return super(Py3oReport, self)._renders_in_process(concurrency)
+
+    @api.multi
+    def _get_fusion_fields(self):
+        """ Return the fields of the requests to the fusion server, but the
+        datadicts, encoded in JSON when the requests are sent
+        """
+        self.ensure_one()
+        report_xml = self.ir_actions_report_xml_id
+        fields = {
+            "targetformat": report_xml.py3o_filetype,
+            "image_mapping": "{}",
+            "escape_false": "on",
+        }
+        if report_xml.py3o_is_local_fusion:
+            fields['skipfusion'] = '1'
+        return fields
+
+    @api.model
+    def _get_fusion_serializer(self):
+        """ Return the serializer encoding the datadicts in JSON """
+        return serializer.get_serializer(
+            self.env['ir.config_parameter'].get_param('py3o.json_backend'))
+
+    @api.multi
+    def _get_fusion_endpoints(self):
+        """ Return the servers to which the requests can be sent. They are
+        resolved once for all the records of a report, see
+        _create_report_file.
+        """
+        self.ensure_one()
+        held = _get_held_endpoints().get((self.env.cr.dbname, self.id))
+        if held is not None:
+            return held
+        report_xml = self.ir_actions_report_xml_id
+        endpoints = []
+        for server in report_xml._get_py3o_servers():
+            endpoint_fields = {}
+            options = report_xml.pdf_options_id or server.pdf_options_id
+            if report_xml.py3o_filetype == 'pdf' and options:
+                endpoint_fields['pdf_options'] = \
+                    options._get_libreoffice_options_payload()
+            endpoints.append(server._get_endpoint(endpoint_fields))
+        return endpoints
+
+    @api.multi
+    def _get_fusion_datadict(self, cached_template, model_instance, data):
+        localcontext = self._get_parser_context(model_instance, data)
+        # the analysis of the template expressions is done once
+        return cached_template.data_struct.render(localcontext)
+
+    @api.multi
+    def _prepare_fusion_request(self, model_instance, data, endpoints=None):
+        """ Build the request rendering ``model_instance`` with the fusion
+        server: all the data it needs is read here. ``endpoints`` are the
+        servers returned by _get_fusion_endpoints.
         """
         self.ensure_one()
         report_xml = self.ir_actions_report_xml_id
         filetype = report_xml.py3o_filetype
-        if not report_xml.py3o_server_id:
-            return super(Py3oReport, self)._create_single_report(
-                model_instance, data, save_in_attachment,
-            )
-        elif report_xml.py3o_is_local_fusion:
+        # the rendered documents sent in local fusion are never the same
+        tmpl_data = tmpl_path = tmpl_hash = None
+        if report_xml.py3o_is_local_fusion:
             result_path = super(
                 Py3oReport, self.with_context(
                     report_py3o_skip_conversion=True,
                 )
-            )._create_single_report(
-                model_instance, data, save_in_attachment,
-            )
-            with closing(open(result_path, 'r')) as out_stream:
-                tmpl_data = out_stream.read()
+            )._create_single_report(model_instance, data, {})
+            # the rendered document is sent to the server, which will
+            # write the converted one in its place
+            tmpl_path = result_path
             datadict = {}
         else:
             result_fd, result_path = tempfile.mkstemp(
                 suffix='.' + filetype, prefix='p3o.report.tmp.')
-            tmpl_data = self.get_template(model_instance)
-
-            in_stream = StringIO(tmpl_data)
-            with closing(os.fdopen(result_fd, 'w+')) as out_stream:
-                template = Template(in_stream, out_stream, escape_false=True)
-                localcontext = self._get_parser_context(model_instance, data)
-                expressions = template.get_all_user_python_expression()
-                py_expression = template.convert_py3o_to_python_ast(
-                    expressions)
-                convertor = Py3oConvertor()
-                data_struct = convertor(py_expression)
-                datadict = data_struct.render(localcontext)
+            os.close(result_fd)
+            cached_template = self._get_cached_template(model_instance)
+            tmpl_data = cached_template.tmpl_data
+            tmpl_hash = cached_template.tmpl_hash
+            datadict = self._get_fusion_datadict(
+                cached_template, model_instance, data)
 
-        # Call py3o.server to render the template in the desired format
-        files = {
-            'tmpl_file': tmpl_data,
-        }
-        fields = {
-            "targetformat": filetype,
-            "datadict": json.dumps(datadict),
-            "image_mapping": "{}",
-            "escape_false": "on",
-        }
-        if report_xml.py3o_is_local_fusion:
-            fields['skipfusion'] = '1'
-        url = report_xml.py3o_server_id.url
-        logger.info(
-            'Connecting to %s to convert report %s to %s',
-            url, report_xml.report_name, filetype)
-        if filetype == 'pdf':
-            options = report_xml.pdf_options_id or\
-                report_xml.py3o_server_id.pdf_options_id
-            if options:
-                pdf_options_dict = options.odoo2libreoffice_options()
-                fields['pdf_options'] = json.dumps(pdf_options_dict)
-                logger.debug('PDF Export options: %s', pdf_options_dict)
-        start_chrono = datetime.now()
-        r = requests.post(url, data=fields, files=files)
-        if r.status_code != 200:
+        return FusionRequest(
+            endpoints or self._get_fusion_endpoints(),
+            self._get_fusion_fields(), result_path,
+            tmpl_data=tmpl_data,
+            tmpl_path=tmpl_path,
+            report_name=report_xml.report_name,
+            balancing=report_xml.py3o_server_balancing,
+            tmpl_hash=tmpl_hash,
+            json_fields={'datadict': datadict},
+            json_serializer=self._get_fusion_serializer(),
+        )
+
+    @api.multi
+    def _prepare_fusion_batch_request(self, model_instances, data,
+                                      merge=False, endpoints=None):
+        """ Build the request rendering the documents of all
+        ``model_instances``, which use the same template, at once. With
+        ``merge``, the server returns a single document.
+        """
+        self.ensure_one()
+        report_xml = self.ir_actions_report_xml_id
+        filetype = report_xml.py3o_filetype
+        cached_template = self._get_cached_template(model_instances[0])
+        fields = self._get_fusion_fields()
+        datadicts = [
+            self._get_fusion_datadict(cached_template, model_instance, data)
+            for model_instance in model_instances
+        ]
+        result_paths = None
+        if merge:
+            fields['merge'] = '1'
+        else:
+            result_paths = []
+            for dummy in model_instances:
+                result_fd, result_path = tempfile.mkstemp(
+                    suffix='.' + filetype, prefix='p3o.report.tmp.')
+                os.close(result_fd)
+                result_paths.append(result_path)
+        result_fd, result_path = tempfile.mkstemp(
+            suffix='.' + (merge and filetype or 'zip'),
+            prefix='p3o.report.tmp.')
+        os.close(result_fd)
+        return FusionBatchRequest(
+            endpoints or self._get_fusion_endpoints(), fields, result_path,
+            result_paths=result_paths,
+            tmpl_data=cached_template.tmpl_data,
+            report_name=report_xml.report_name,
+            balancing=report_xml.py3o_server_balancing,
+            tmpl_hash=cached_template.tmpl_hash,
+            json_fields={'datadicts': datadicts},
+            json_serializer=self._get_fusion_serializer(),
+        )
+
+    @api.model
+    def _check_fusion_error(self, error):
+        if error:
             # server says we have an issue... let's tell that to enduser
-            logger.error('Py3o fusion server error: %s', r.text)
             raise UserError(
-                _('Fusion server error %s') % r.text,
+                _('Fusion server error %s') % error,
             )
 
-        chunk_size = 1024
-        with open(result_path, 'w+') as fd:
-            for chunk in r.iter_content(chunk_size):
-                fd.write(chunk)
-        end_chrono = datetime.now()
-        convert_seconds = (end_chrono - start_chrono).total_seconds()
-        logger.info(
-            'Report %s converted to %s in %s seconds',
-            report_xml.report_name, filetype, convert_seconds)
+    @api.multi
+    def _create_single_report(self, model_instance, data, save_in_attachment):
+        """ This function to generate our py3o report
+        """
+        self.ensure_one()
+        if not self.ir_actions_report_xml_id.py3o_server_id:
+            return super(Py3oReport, self)._create_single_report(
+                model_instance, data, save_in_attachment,
+            )
+        # Call py3o.server to render the template in the desired format
+        fusion_request = self._prepare_fusion_request(model_instance, data)
+        self._check_fusion_error(fusion_request.send())
         if len(model_instance) == 1:
             self._postprocess_report(
-                result_path, model_instance.id, save_in_attachment)
-        return result_path
+                fusion_request.result_path, model_instance.id,
+                save_in_attachment)
+        return fusion_request.result_path
+
+    @api.multi
+    def _create_report_file(self, res_ids, data):
+        held_endpoints = _get_held_endpoints()
+        key = (self.env.cr.dbname, self.id)
+        if not self.ir_actions_report_xml_id.py3o_server_id or \
+                len(res_ids) <= 1 or key in held_endpoints:
+            return super(Py3oReport, self)._create_report_file(res_ids, data)
+        # the records rendered one by one share the servers resolved here
+        held_endpoints[key] = self._get_fusion_endpoints()
+        try:
+            return super(Py3oReport, self)._create_report_file(
+                res_ids, data)
+        finally:
+            del held_endpoints[key]
+
+    @api.multi
+    def _send_fusion_requests(self, fusion_requests, concurrency):
+        """ Send the requests to the fusion server, ``concurrency`` at a
+        time, and return their errors.
+        """
+        if concurrency <= 1 or len(fusion_requests) <= 1:
+            return [request.send() for request in fusion_requests]
+        pool = ThreadPool(min(concurrency, len(fusion_requests)))
+        try:
+            return pool.map(_send_fusion_request, fusion_requests)
+        finally:
+            pool.close()
+            pool.join()
+
+    @api.multi
+    def _create_fusion_reports(self, model_instances, data,
+                               save_in_attachment, concurrency=1,
+                               batch_size=0, endpoints=None):
+        """ Render the records with requests to the fusion server, each of
+        them rendering up to ``batch_size`` records. The requests are
+        prepared and sent ``concurrency`` at a time, so only their data is
+        in memory. The returned paths are in the same order as
+        ``model_instances``.
+
+        ``endpoints`` are the servers returned by _get_fusion_endpoints,
+        resolved here if not given.
+        """
+        self.ensure_one()
+        report_xml = self.ir_actions_report_xml_id
+        save_in_attachment = save_in_attachment or {}
+        loaded_documents = save_in_attachment.get('loaded_documents') or {}
+        batch = batch_size > 1 and not report_xml.py3o_is_local_fusion
+        # without documents to load or save, the server can merge the
+        # documents of each request
+        merge = batch and report_xml.py3o_filetype == 'pdf' and \
+            not loaded_documents and \
+            not any(save_in_attachment.get(res_id)
+                    for res_id in model_instances.ids)
+        # consecutive records rendered by the same request, or loaded from
+        # their attachment
+        groups = []
+        for model_instance in model_instances:
+            loaded = model_instance.id in loaded_documents
+            tmpl_hash = batch and not loaded and self._get_cached_template(
+                model_instance).tmpl_hash
+            if batch and not loaded and groups and \
+                    groups[-1]['tmpl_hash'] == tmpl_hash and \
+                    len(groups[-1]['records']) < batch_size:
+                groups[-1]['records'] |= model_instance
+            else:
+                groups.append({
+                    'records': model_instance,
+                    'loaded': loaded,
+                    'tmpl_hash': tmpl_hash,
+                })
+        reports_path = []
+        requests_path = []
+        # the servers and their pdf options are resolved once
+        endpoints = endpoints or self._get_fusion_endpoints()
+        try:
+            for chunk in tools.split_every(max(concurrency, 1), groups):
+                fusion_requests = []
+                for group in chunk:
+                    if group['loaded']:
+                        reports_path.append(
+                            self._get_or_create_single_report(
+                                group['records'], data, save_in_attachment))
+                        continue
+                    if batch:
+                        fusion_request = self._prepare_fusion_batch_request(
+                            group['records'], data, merge=merge,
+                            endpoints=endpoints)
+                    else:
+                        fusion_request = self._prepare_fusion_request(
+                            group['records'], data, endpoints=endpoints)
+                    fusion_requests.append(fusion_request)
+                    requests_path.append(fusion_request.result_path)
+                    if batch and not merge:
+                        group['paths'] = fusion_request.result_paths
+                    else:
+                        group['paths'] = [fusion_request.result_path]
+                    reports_path += group['paths']
+                errors = self._send_fusion_requests(
+                    fusion_requests, concurrency)
+                for error in errors:
+                    self._check_fusion_error(error)
+                for group in chunk:
+                    if group['loaded'] or merge:
+                        continue
+                    for model_instance, result_path in zip(
+                            group['records'], group['paths']):
+                        self._postprocess_report(
+                            result_path, model_instance.id,
+                            save_in_attachment)
+        except Exception:
+            self._cleanup_tempfiles([
+                path for path in set(reports_path).union(requests_path)
+                if os.path.exists(path)])
+            raise
+        return reports_path
+
+    @api.multi
+    def _create_reports_parallel(self, model_instances, data,
+                                 save_in_attachment, concurrency):
+        """ Keep ``concurrency`` requests in flight to the fusion server """
+        if not self.ir_actions_report_xml_id.py3o_server_id:
+            return super(Py3oReport, self)._create_reports_parallel(
+                model_instances, data, save_in_attachment, concurrency)
+        return self._create_fusion_reports(
+            model_instances, data, save_in_attachment,
+            concurrency=concurrency,
+            batch_size=self._get_conversion_batch_size())
+
+    @api.multi
+    def _create_reports_batch_conversion(self, model_instances, data,
+                                         save_in_attachment, batch_size):
+        """ Render ``batch_size`` records with each request to the fusion
+        server
+        """
+        if not self.ir_actions_report_xml_id.py3o_server_id:
+            return super(Py3oReport, self)._create_reports_batch_conversion(
+                model_instances, data, save_in_attachment, batch_size)
+        return self._create_fusion_reports(
+            model_instances, data, save_in_attachment, batch_size=batch_size)
@@ -1,7 +1,25 @@
 # -*- coding: utf-8 -*-
 # Copyright 2013 XCG Consulting (http://odoo.consulting)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
-from odoo import fields, models
+import logging
+import threading
+from datetime import datetime
+
+from odoo import api, fields, models
+from . import server_pool
+
+logger = logging.getLogger(__name__)
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    logger.debug('Cannot import requests')
+
+# HTTP sessions of the current process, by database and server
+_sessions = {}
+_sessions_lock = threading.Lock()
 
 
 class Py3oServer(models.Model):
@@ -17,3 +35,136 @@ class Py3oServer(models.Model):
         'py3o.pdf.options', string='PDF Options', ondelete='restrict',
         help="PDF options can be set per Py3o Server but also per report. "
         "If both are defined, the options on the report are used.")
+    pool_size = fields.Integer(
+        "Connection Pool Size", default=10,
+        help="Maximum number of connections to the server kept open by "
+        "each Odoo worker.")
+    timeout = fields.Integer(
+        "Timeout", default=600,
+        help="Number of seconds to wait for the server to answer. "
+        "0 waits forever.")
+    retries = fields.Integer(
+        "Retries", default=3,
+        help="Number of times a request is sent again when the server "
+        "can't be reached or answers that it is unavailable (502, 503 or "
+        "504 error). Requests that time out are not sent again.")
+    retry_backoff = fields.Float(
+        "Retry Backoff", default=0.5,
+        help="The delay between two retries is this number of seconds, "
+        "doubled after each retry.")
+    chunk_size = fields.Integer(
+        "Download Chunk Size", default=64,
+        help="Size in kilobytes of the chunks read from the server "
+        "responses.")
+    max_failures = fields.Integer(
+        "Failures Before Ejection", default=3,
+        help="The server stops receiving requests after failing that many "
+        "times in a row. 0 never ejects it.")
+    eject_duration = fields.Integer(
+        "Ejection Duration", default=30,
+        help="Number of seconds during which an ejected server receives no "
+        "request. It is checked before receiving requests again.")
+    template_dedup = fields.Boolean(
+        "Template Deduplication",
+        help="The server keeps the templates it receives: a template "
+        "already sent is referred to by its sha256 digest (tmpl_hash field) "
+        "instead of being uploaded with each document. The server answers "
+        "with a 412 error to request an upload of a template it lost. "
+        "The standard Py3o Fusion server doesn't support it.")
+    stream_upload = fields.Boolean(
+        "Stream Uploads",
+        help="Encode the data of the documents into temporary files read "
+        "while the requests are sent, so that the data of big documents is "
+        "never held in memory as a whole.")
+    batch_size = fields.Integer(
+        "Documents per Request", default=0,
+        help="When a report is printed for several records, send the data "
+        "of that many documents with each request (datadicts field). The "
+        "server answers with a zip file of the documents, or with a single "
+        "merged PDF file when the field merge is set. The standard Py3o "
+        "Fusion server doesn't support it, 0 or 1 sends a request per "
+        "document.")
+    stat_requests = fields.Integer(
+        "Requests", compute='_compute_stats',
+        help="Number of requests sent by the current Odoo worker.")
+    stat_errors = fields.Integer(
+        "Errors", compute='_compute_stats',
+        help="Number of requests that the server failed to answer.")
+    stat_outstanding = fields.Integer(
+        "Requests In Progress", compute='_compute_stats')
+    stat_latency = fields.Float(
+        "Average Latency", compute='_compute_stats',
+        help="Average number of seconds to render a document.")
+    stat_ejected_until = fields.Datetime(
+        "Ejected Until", compute='_compute_stats')
+
+    @api.multi
+    def _get_stats_key(self):
+        self.ensure_one()
+        return (self.env.cr.dbname, self.id)
+
+    @api.multi
+    def _compute_stats(self):
+        for server in self:
+            stats = server_pool.get_stats(server._get_stats_key())
+            server.stat_requests = stats.requests
+            server.stat_errors = stats.errors
+            server.stat_outstanding = stats.outstanding
+            server.stat_latency = stats.average_latency
+            server.stat_ejected_until = stats.is_ejected() and \
+                fields.Datetime.to_string(datetime.utcfromtimestamp(
+                    stats.ejected_until))
+
+    @api.multi
+    def _get_endpoint(self, endpoint_fields=None):
+        """ Return what is needed to send requests to this server without
+        the ORM.
+        """
+        self.ensure_one()
+        return server_pool.Endpoint(
+            self._get_stats_key(), self.url, self._get_session(),
+            timeout=self.timeout or None,
+            chunk_size=max(self.chunk_size, 1) * 1024,
+            fields=endpoint_fields,
+            max_failures=self.max_failures,
+            eject_duration=self.eject_duration,
+            template_dedup=self.template_dedup,
+            stream_upload=self.stream_upload,
+        )
+
+    @api.multi
+    def _get_session(self):
+        """ Return the HTTP session of the current process for this server.
+        Its connections are kept alive and reused by all the requests sent
+        to the server.
+        """
+        self.ensure_one()
+        key = self._get_stats_key()
+        config = (self.url, self.pool_size, self.retries, self.retry_backoff)
+        with _sessions_lock:
+            session_config, session = _sessions.get(key, (None, None))
+            if session is not None and session_config == config:
+                return session
+            if session is not None:
+                session.close()
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=max(self.pool_size, 1),
+                max_retries=Retry(
+                    total=self.retries,
+                    # a request without answer may still be rendering on
+                    # the server: it is not sent again
+                    read=0,
+                    backoff_factor=self.retry_backoff,
+                    status_forcelist=(502, 503, 504),
+                    # the requests refused by the server or never delivered
+                    # can be sent again
+                    method_whitelist=frozenset(['GET', 'POST']),
+                    raise_on_status=False,
+                ),
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = (config, session)
+            return session
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
+"""Serialization of the data sent to the fusion server.
+
+The datadicts are JSON encoded by simplejson when it is installed, its C
+speedups being faster than the json module of Python 2, or by the backend
+chosen with the ``py3o.json_backend`` system parameter. Dates, decimals
+and binary values are converted like Odoo would show them.
+"""
+import base64
+import datetime
+import decimal
+import json
+import logging
+import os
+import tempfile
+import uuid
+from collections import OrderedDict
+from cStringIO import StringIO
+
+from odoo.tools import DEFAULT_SERVER_DATE_FORMAT, \
+    DEFAULT_SERVER_DATETIME_FORMAT
+
+logger = logging.getLogger(__name__)
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+    logger.debug('Cannot import simplejson')
+
+# size of the chunks of a streamed request body
+CHUNK_SIZE = 64 * 1024
+# size of the JSON data of a streamed request body kept in memory
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+def _default(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+    if isinstance(value, datetime.date):
+        return value.strftime(DEFAULT_SERVER_DATE_FORMAT)
+    if isinstance(value, (datetime.time, uuid.UUID)):
+        return str(value)
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (bytearray, buffer)):
+        return base64.b64encode(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError('%r is not JSON serializable' % (value, ))
+
+
+class JSONSerializer(object):
+    """Encode values with the stdlib json module"""
+
+    name = 'json'
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(default=_default)
+
+    def dumps(self, value):
+        return self._encoder.encode(value)
+
+    def iterencode(self, value):
+        """Yield the encoded value in chunks, without building the whole
+        string
+        """
+        buf = []
+        size = 0
+        for part in self._encoder.iterencode(value):
+            buf.append(part)
+            size += len(part)
+            if size >= CHUNK_SIZE:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        if buf:
+            yield ''.join(buf)
+
+
+class SimpleJSONSerializer(JSONSerializer):
+
+    name = 'simplejson'
+
+    def __init__(self):
+        self._encoder = simplejson.JSONEncoder(
+            default=_default, use_decimal=False)
+
+
+# the backends, the fastest first
+BACKENDS = OrderedDict()
+if simplejson is not None:
+    BACKENDS[SimpleJSONSerializer.name] = SimpleJSONSerializer
+BACKENDS[JSONSerializer.name] = JSONSerializer
+
+
+def register_backend(serializer_class, preferred=False):
+    """Make ``serializer_class`` available, as the default backend with
+    ``preferred``
+    """
+    BACKENDS[serializer_class.name] = serializer_class
+    if preferred:
+        for name in BACKENDS.keys():
+            if name != serializer_class.name:
+                BACKENDS[name] = BACKENDS.pop(name)
+
+
+def get_serializer(name=None):
+    """Return the serializer of the backend ``name``, or of the fastest
+    one installed
+    """
+    if name and name not in BACKENDS:
+        logger.warning('Unknown JSON backend %s, using the default one',
+                       name)
+        name = None
+    return BACKENDS[name or next(iter(BACKENDS))]()
+
+
+class MultipartBody(object):
+    """A multipart/form-data request body read while it is sent.
+
+    The JSON fields are encoded into temporary files, kept in memory up to
+    ``max_size`` bytes each, so the JSON data is never held in memory as a
+    string. The body has a known length and can be read again from its
+    start when the request is retried.
+
+    :param fields: the form fields as strings
+    :param json_fields: the form fields to encode in JSON
+    :param files: the files as strings, by field name
+    """
+
+    def __init__(self, fields, json_fields=None, files=None,
+                 serializer=None, max_size=SPOOL_MAX_SIZE):
+        self.boundary = uuid.uuid4().hex
+        serializer = serializer or get_serializer()
+        self._parts = []
+        for name, value in fields.items():
+            self._add_string(
+                '%s%s\r\n' % (self._header(name), _to_str(value)))
+        for name, value in (json_fields or {}).items():
+            self._add_string(self._header(name))
+            json_file = tempfile.SpooledTemporaryFile(max_size=max_size)
+            for chunk in serializer.iterencode(value):
+                json_file.write(chunk)
+            self._parts.append((json_file, json_file.tell()))
+            self._add_string('\r\n')
+        for name, value in (files or {}).items():
+            self._add_string(self._header(name, filename=name))
+            self._add_string(value)
+            self._add_string('\r\n')
+        self._add_string('--%s--\r\n' % self.boundary)
+        self.len = sum(size for dummy, size in self._parts)
+        self.seek(0)
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def _header(self, name, filename=None):
+        disposition = 'form-data; name="%s"' % name
+        if filename:
+            disposition += '; filename="%s"' % filename
+        return '--%s\r\nContent-Disposition: %s\r\n\r\n' % (
+            self.boundary, disposition)
+
+    def _add_string(self, value):
+        # reading the string doesn't copy it
+        self._parts.append((StringIO(value), len(value)))
+
+    def __len__(self):
+        return self.len
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.len
+        self._position = min(max(offset, 0), self.len)
+        self._index = None
+        start = 0
+        for index, (part, size) in enumerate(self._parts):
+            if self._index is None and self._position < start + size:
+                self._index = index
+                part.seek(self._position - start)
+            start += size
+        if self._index is None:
+            self._index = len(self._parts)
+
+    def read(self, size=-1):
+        chunks = []
+        while self._index < len(self._parts) and size != 0:
+            part = self._parts[self._index][0]
+            chunk = part.read() if size < 0 else part.read(size)
+            if not chunk:
+                self._index += 1
+                if self._index < len(self._parts):
+                    self._parts[self._index][0].seek(0)
+                continue
+            chunks.append(chunk)
+            self._position += len(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return ''.join(chunks)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        for part, dummy in self._parts:
+            part.close()
+
+
+def _to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
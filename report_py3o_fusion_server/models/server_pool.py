@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
+"""Balancing of the fusion requests between several py3o servers.
+
+The state of each server (requests in flight, counters and ejection) is kept
+by each Odoo process for its own requests.
+"""
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+ROUND_ROBIN = 'round_robin'
+LEAST_OUTSTANDING = 'least_outstanding'
+# number of template digests remembered for each server
+MAX_KNOWN_TEMPLATES = 1000
+
+_stats = {}
+_counters = {}
+_lock = threading.Lock()
+
+
+class ServerStats(object):
+    """Counters of the requests sent to a server"""
+
+    def __init__(self):
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.total_latency = 0.0
+        self.ejected_until = 0
+        # digests of the templates stored by the server
+        self.templates = set()
+
+    @property
+    def average_latency(self):
+        successes = self.requests - self.errors
+        return successes and self.total_latency / successes or 0.0
+
+    def is_ejected(self, now=None):
+        return self.ejected_until > (now or time.time())
+
+    def needs_check(self, now=None):
+        """The server was ejected and has not been checked since"""
+        return bool(self.ejected_until) and not self.is_ejected(now)
+
+
+def get_stats(key):
+    with _lock:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = _stats[key] = ServerStats()
+        return stats
+
+
+class Endpoint(object):
+    """A server to which a fusion request can be sent
+
+    :param key: identifies the server in the counters of the process
+    :param max_failures: eject the server after that many failed requests
+        in a row (0 means never)
+    :param eject_duration: number of seconds during which an ejected
+        server doesn't receive requests
+
+    :param template_dedup: whether the server stores the templates it
+        receives, so that they can be referred to by their digest
+    :param stream_upload: whether to generate the request bodies while they
+        are sent
+    """
+
+    def __init__(self, key, url, session, timeout=None,
+                 chunk_size=64 * 1024, fields=None, max_failures=0,
+                 eject_duration=0, template_dedup=False,
+                 stream_upload=False):
+        self.key = key
+        self.url = url
+        self.session = session
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.fields = fields or {}
+        self.max_failures = max_failures
+        self.eject_duration = eject_duration
+        self.template_dedup = template_dedup
+        self.stream_upload = stream_upload
+
+    @property
+    def stats(self):
+        return get_stats(self.key)
+
+    def acquire(self):
+        stats = self.stats
+        with _lock:
+            stats.outstanding += 1
+            stats.requests += 1
+        return time.time()
+
+    def release(self, start, failed=False):
+        stats = self.stats
+        with _lock:
+            stats.outstanding -= 1
+            if not failed:
+                stats.consecutive_errors = 0
+                stats.total_latency += time.time() - start
+                return
+            stats.errors += 1
+            stats.consecutive_errors += 1
+            if self.max_failures and \
+                    stats.consecutive_errors >= self.max_failures:
+                logger.warning(
+                    'Ejecting py3o server %s for %s seconds after %d errors',
+                    self.url, self.eject_duration, stats.consecutive_errors)
+                stats.ejected_until = time.time() + self.eject_duration
+                stats.consecutive_errors = 0
+
+    def knows_template(self, tmpl_hash):
+        return tmpl_hash in self.stats.templates
+
+    def set_template_known(self, tmpl_hash, known=True):
+        stats = self.stats
+        with _lock:
+            if not known:
+                stats.templates.discard(tmpl_hash)
+                return
+            if len(stats.templates) >= MAX_KNOWN_TEMPLATES:
+                stats.templates.clear()
+            stats.templates.add(tmpl_hash)
+
+    def check_health(self):
+        """Probe a server coming back from an ejection. Return whether it
+        answers, ejecting it again otherwise.
+        """
+        try:
+            response = self.session.get(self.url, timeout=self.timeout)
+            healthy = response.status_code < 500
+            response.close()
+        except Exception:
+            logger.debug('Health check of %s failed', self.url,
+                         exc_info=True)
+            healthy = False
+        stats = self.stats
+        with _lock:
+            if healthy:
+                stats.ejected_until = 0
+            else:
+                stats.ejected_until = time.time() + self.eject_duration
+        if not healthy:
+            logger.warning('Py3o server %s is still unavailable', self.url)
+        return healthy
+
+
+def order_endpoints(endpoints, balancing=ROUND_ROBIN):
+    """Return the endpoints in the order in which they have to be tried:
+    the available servers sorted by the balancing policy, then the ejected
+    ones in case all the others fail.
+    """
+    now = time.time()
+    available = [e for e in endpoints if not e.stats.is_ejected(now)]
+    ejected = [e for e in endpoints if e.stats.is_ejected(now)]
+    if len(available) > 1:
+        if balancing == LEAST_OUTSTANDING:
+            available.sort(key=lambda e: e.stats.outstanding)
+        else:
+            group = tuple(sorted(e.key for e in endpoints))
+            with _lock:
+                counter = _counters.get(group)
+                if counter is None:
+                    counter = _counters[group] = itertools.count()
+                start = next(counter) % len(available)
+            available = available[start:] + available[:start]
+    ejected.sort(key=lambda e: e.stats.ejected_until)
+    return available + ejected
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+        _counters.clear()
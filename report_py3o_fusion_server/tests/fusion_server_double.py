@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
+import cgi
+import hashlib
+import json
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from StringIO import StringIO
+from zipfile import ZipFile
+
+
+class FusionServerDouble(object):
+    """ A local stand-in for the py3o fusion server, answering every
+    document with ``result``. With ``template_dedup``, it keeps the
+    templates it receives by their sha256 digest.
+
+    Requests with a ``datadicts`` field get a zip file holding a document
+    per datadict, or a single document when they have a ``merge`` field.
+
+    The fields of the requests it received are in ``requests``, with a
+    ``tmpl_upload`` key telling whether the template was uploaded. The next
+    ``unavailable`` requests are answered with a 503 error.
+    """
+
+    def __init__(self, template_dedup=True, result='test_result'):
+        self.template_dedup = template_dedup
+        self.result = result
+        self.templates = {}
+        self.requests = []
+        self.unavailable = 0
+        # number of requests received with a chunked transfer encoding
+        self.chunked_requests = 0
+        self.url = None
+        self._httpd = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._httpd = HTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.url = 'http://127.0.0.1:%d/form' % self._httpd.server_port
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def handle(self, form):
+        """ Return the status and the body of the answer to ``form`` """
+        fields = dict(
+            (key, form.getvalue(key)) for key in form.keys()
+            if key != 'tmpl_file')
+        fields['tmpl_upload'] = 'tmpl_file' in form
+        self.requests.append(fields)
+        if self.unavailable:
+            self.unavailable -= 1
+            return 503, 'Service unavailable'
+        tmpl_hash = fields.get('tmpl_hash')
+        if 'tmpl_file' in form:
+            tmpl_data = form['tmpl_file'].value
+            if self.template_dedup and tmpl_hash:
+                if hashlib.sha256(tmpl_data).hexdigest() != tmpl_hash:
+                    return 400, 'Template digest mismatch'
+                self.templates[tmpl_hash] = tmpl_data
+        elif not self.template_dedup or tmpl_hash not in self.templates:
+            return 412, 'Unknown template'
+        if 'datadicts' in fields and not fields.get('merge'):
+            result = StringIO()
+            with ZipFile(result, 'w') as zf:
+                for i, dummy in enumerate(json.loads(fields['datadicts'])):
+                    zf.writestr(
+                        '%d.%s' % (i, fields['targetformat']), self.result)
+            return 200, result.getvalue()
+        return 200, self.result
+
+    def _handler_class(self):
+        double = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _answer(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._answer(200, 'Py3o fusion server double')
+
+            def _read_chunked(self):
+                body = StringIO()
+                while True:
+                    size = int(self.rfile.readline().split(';')[0], 16)
+                    if not size:
+                        self.rfile.readline()
+                        break
+                    body.write(self.rfile.read(size))
+                    self.rfile.readline()
+                return body
+
+            def do_POST(self):
+                fp = self.rfile
+                content_length = self.headers.get('Content-Length')
+                if self.headers.get('Transfer-Encoding') == 'chunked':
+                    fp = self._read_chunked()
+                    content_length = str(fp.tell())
+                    fp.seek(0)
+                    double.chunked_requests += 1
+                form = cgi.FieldStorage(
+                    fp=fp, headers=self.headers, environ={
+                        'REQUEST_METHOD': 'POST',
+                        'CONTENT_TYPE': self.headers['Content-Type'],
+                        'CONTENT_LENGTH': content_length,
+                    })
+                self._answer(*double.handle(form))
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -1,13 +1,24 @@
 # -*- coding: utf-8 -*-
 # Copyright 2017 Therp BV <http://therp.nl>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+import datetime
+import decimal
+import json
 import mock
-from odoo.exceptions import ValidationError
+import os
+import requests
+from odoo.exceptions import UserError, ValidationError
+from odoo.addons.report_py3o.models import template_cache
 from odoo.addons.report_py3o.tests import test_report_py3o
+from ..models import py3o_report, serializer, server_pool
+from .fusion_server_double import FusionServerDouble
+
+# the tests of this class talk to a fusion server double with the real method
+_session_post = requests.Session.post
 
 
 @mock.patch(
-    'requests.post', mock.Mock(
+    'requests.Session.post', mock.Mock(
         return_value=mock.Mock(
             status_code=200,
             iter_content=mock.Mock(return_value=['test_result']),
@@ -41,3 +52,416 @@ class TestReportPy3oFusionServer(test_report_py3o.TestReportPy3o):
         for options in self.env['py3o.pdf.options'].search([]):
             options_dict = options.odoo2libreoffice_options()
             self.assertIsInstance(options_dict, dict)
+
+    def test_pdf_options_payload(self):
+        options = self.env['py3o.pdf.options'].create({'name': 'Test'})
+        options_model = type(options)
+        self.report.pdf_options_id = options
+        options.clear_caches()
+        with mock.patch.object(
+                options_model, 'odoo2libreoffice_options', autospec=True,
+                side_effect=options_model.odoo2libreoffice_options) as \
+                odoo2libreoffice_options:
+            for dummy in range(3):
+                endpoints = self.py3o_report._get_fusion_endpoints()
+            self.assertEqual(1, odoo2libreoffice_options.call_count)
+            self.assertEqual(
+                options.odoo2libreoffice_options(),
+                json.loads(endpoints[0].fields['pdf_options']))
+            # the options are computed again once modified
+            options.pdfa = True
+            endpoints = self.py3o_report._get_fusion_endpoints()
+            pdf_options = json.loads(endpoints[0].fields['pdf_options'])
+            self.assertEqual(1, pdf_options['SelectPdfVersion'])
+
+    def test_server_session(self):
+        server = self.report.py3o_server_id
+        session = server._get_session()
+        # the session and its connections are reused
+        self.assertIs(session, server._get_session())
+        adapter = session.get_adapter(server.url)
+        self.assertEqual(server.retries, adapter.max_retries.total)
+        # the renderings that time out are not sent again
+        self.assertEqual(0, adapter.max_retries.read)
+        server.write({'pool_size': 2, 'retries': 5})
+        new_session = server._get_session()
+        self.assertIsNot(session, new_session)
+        self.assertEqual(5, new_session.get_adapter(
+            server.url).max_retries.total)
+
+    def test_fusion_concurrency(self):
+        self.env['ir.config_parameter'].set_param(
+            'py3o.fusion_concurrency', '3')
+        users = self.env['res.users'].search([], limit=4)
+        self.assertEqual(
+            min(3, len(users)),
+            self.py3o_report._get_render_concurrency(users))
+        # the datadicts are built by the current transaction: the records
+        # are prefetched
+        self.assertTrue(self.py3o_report._renders_in_process(3))
+        post = mock.Mock(return_value=mock.Mock(
+            status_code=200,
+            iter_content=mock.Mock(return_value=['test_result']),
+        ))
+        with mock.patch('requests.Session.post', post):
+            reports_path = self.py3o_report._create_reports_parallel(
+                users, {}, {}, 3)
+        try:
+            self.assertEqual(len(users), post.call_count)
+            self.assertEqual(len(users), len(set(reports_path)))
+            for report_path in reports_path:
+                with open(report_path) as report_file:
+                    self.assertEqual('test_result', report_file.read())
+        finally:
+            self.py3o_report._cleanup_tempfiles(
+                [path for path in reports_path if os.path.exists(path)])
+        post.return_value.status_code = 500
+        post.return_value.text = 'error'
+        with mock.patch('requests.Session.post', post):
+            with self.assertRaises(UserError):
+                self.py3o_report._create_reports_parallel(
+                    users, {}, {}, 3)
+        # the requests are prepared and sent by chunks of the concurrency
+        users = users[:3]
+        post.return_value.status_code = 200
+        py3o_report_class = self.py3o_report.__class__
+        prepare_fusion_request = py3o_report_class._prepare_fusion_request
+        send_fusion_requests = py3o_report_class._send_fusion_requests
+        calls = []
+
+        def prepare(report, *args, **kwargs):
+            calls.append('prepare')
+            return prepare_fusion_request(report, *args, **kwargs)
+
+        def send(report, fusion_requests, concurrency):
+            calls.append('send')
+            return send_fusion_requests(report, fusion_requests, concurrency)
+
+        with mock.patch('requests.Session.post', post), \
+                mock.patch.object(
+                    py3o_report_class, '_prepare_fusion_request',
+                    autospec=True, side_effect=prepare), \
+                mock.patch.object(
+                    py3o_report_class, '_send_fusion_requests',
+                    autospec=True, side_effect=send):
+            reports_path = self.py3o_report._create_reports_parallel(
+                users, {}, {}, 2)
+        self.py3o_report._cleanup_tempfiles(reports_path)
+        self.assertEqual(
+            ['prepare', 'prepare', 'send', 'prepare', 'send'], calls)
+
+    def test_fusion_endpoints(self):
+        users = self.env['res.users'].search([], limit=3)
+        py3o_report_class = self.py3o_report.__class__
+        server_class = self.report.py3o_server_id.__class__
+        contexts = []
+        create_single_report = py3o_report_class._create_single_report
+
+        def create_report(report, *args):
+            contexts.append(report.env.context)
+            return create_single_report(report, *args)
+
+        with mock.patch.object(
+                server_class, '_get_endpoint', autospec=True,
+                side_effect=server_class._get_endpoint) as get_endpoint, \
+                mock.patch.object(
+                    py3o_report_class, '_create_single_report',
+                    autospec=True, side_effect=create_report), \
+                mock.patch.object(py3o_report_class, '_merge_pdf',
+                                  side_effect=lambda paths: paths[0]):
+            result_path, filetype = self.py3o_report._create_report_file(
+                users.ids, {})
+        self.py3o_report._cleanup_tempfiles([result_path])
+        # the servers are resolved once for all the records
+        self.assertEqual(1, get_endpoint.call_count)
+        self.assertEqual(len(users), len(contexts))
+        # without going through the context, which stays serializable
+        for context in contexts:
+            json.dumps(context)
+        self.assertFalse(py3o_report._get_held_endpoints())
+
+    def test_parallel_rendering(self):
+        # the reports printed without fusion server are rendered by a pool
+        # of processes
+        self.report.write({
+            'py3o_server_id': False,
+            'py3o_filetype': 'odt',
+        })
+        super(TestReportPy3oFusionServer, self).test_parallel_rendering()
+
+    def _send_fusion_request(self):
+        fusion_request = self.py3o_report._prepare_fusion_request(
+            self.env.user, {})
+        try:
+            self.assertIsNone(fusion_request.send())
+            with open(fusion_request.result_path) as result_file:
+                return result_file.read()
+        finally:
+            self.py3o_report._cleanup_tempfiles(
+                [fusion_request.result_path])
+
+    def test_server_balancing(self):
+        server_pool.reset()
+        server = self.report.py3o_server_id
+        other_server = server.copy({'url': 'http://other', 'max_failures': 1})
+        self.report.py3o_server_ids = other_server
+        self.assertEqual(
+            server | other_server, self.report._get_py3o_servers())
+        responses = {
+            server.url: mock.Mock(
+                status_code=200,
+                iter_content=mock.Mock(return_value=['test_result'])),
+            other_server.url: mock.Mock(
+                status_code=200,
+                iter_content=mock.Mock(return_value=['test_result'])),
+        }
+        post = mock.Mock(side_effect=lambda url, **kwargs: responses[url])
+        render = self._send_fusion_request
+
+        with mock.patch('requests.Session.post', post):
+            for dummy in range(4):
+                render()
+            # the requests are sent to each server in turn
+            urls = [call[0][0] for call in post.call_args_list]
+            self.assertEqual(2, urls.count(server.url))
+            self.assertEqual(2, urls.count(other_server.url))
+            self.assertNotEqual(urls[0], urls[1])
+            other_server.invalidate_cache()
+            self.assertEqual(2, other_server.stat_requests)
+            # an unavailable server is ejected, the requests go to the
+            # other one
+            responses[other_server.url].status_code = 503
+            post.reset_mock()
+            for dummy in range(3):
+                render()
+            urls = [call[0][0] for call in post.call_args_list]
+            self.assertEqual(1, urls.count(other_server.url))
+            self.assertEqual(3, urls.count(server.url))
+            other_server.invalidate_cache()
+            self.assertEqual(1, other_server.stat_errors)
+            self.assertTrue(other_server.stat_ejected_until)
+            # until it is healthy again
+            stats = server_pool.get_stats(other_server._get_stats_key())
+            stats.ejected_until = 1
+            responses[other_server.url].status_code = 200
+            with mock.patch('requests.Session.get') as get:
+                get.return_value.status_code = 200
+                post.reset_mock()
+                for dummy in range(2):
+                    render()
+            self.assertEqual(1, get.call_count)
+            urls = [call[0][0] for call in post.call_args_list]
+            self.assertIn(other_server.url, urls)
+        server_pool.reset()
+
+    def test_server_error_ejection(self):
+        server_pool.reset()
+        server = self.report.py3o_server_id
+        other_server = server.copy({'url': 'http://other', 'max_failures': 2})
+        self.report.py3o_server_ids = other_server
+        responses = {
+            server.url: mock.Mock(
+                status_code=200,
+                iter_content=mock.Mock(return_value=['test_result'])),
+            other_server.url: mock.Mock(
+                status_code=500, text='Internal Server Error'),
+        }
+        post = mock.Mock(side_effect=lambda url, **kwargs: responses[url])
+        with mock.patch('requests.Session.post', post):
+            errors = []
+            for dummy in range(6):
+                fusion_request = self.py3o_report._prepare_fusion_request(
+                    self.env.user, {})
+                errors.append(fusion_request.send())
+                self.py3o_report._cleanup_tempfiles(
+                    [fusion_request.result_path])
+        # the server answering 500 is ejected after two errors
+        self.assertEqual(2, errors.count('Internal Server Error'))
+        urls = [call[0][0] for call in post.call_args_list]
+        self.assertEqual(2, urls.count(other_server.url))
+        other_server.invalidate_cache()
+        self.assertEqual(2, other_server.stat_errors)
+        self.assertTrue(other_server.stat_ejected_until)
+        server_pool.reset()
+
+    def test_template_dedup(self):
+        server_pool.reset()
+        self.report.py3o_is_local_fusion = False
+        with FusionServerDouble() as fusion_server, \
+                mock.patch('requests.Session.post', _session_post):
+            self.report.py3o_server_id.write({
+                'url': fusion_server.url,
+                'template_dedup': True,
+            })
+            for dummy in range(3):
+                self.assertEqual('test_result', self._send_fusion_request())
+            # the template is only uploaded with the first document
+            self.assertEqual(
+                [True, False, False],
+                [fields['tmpl_upload'] for fields in fusion_server.requests])
+            self.assertEqual(1, len(fusion_server.templates))
+            # and again when the server lost it
+            fusion_server.templates.clear()
+            del fusion_server.requests[:]
+            self.assertEqual('test_result', self._send_fusion_request())
+            self.assertEqual(
+                [False, True],
+                [fields['tmpl_upload'] for fields in fusion_server.requests])
+            # servers without deduplication always get the template
+            self.report.py3o_server_id.template_dedup = False
+            del fusion_server.requests[:]
+            self._send_fusion_request()
+            self.assertEqual(
+                [(True, None)],
+                [(fields['tmpl_upload'], fields.get('tmpl_hash'))
+                 for fields in fusion_server.requests])
+        server_pool.reset()
+
+    def test_template_dedup_unavailable(self):
+        server_pool.reset()
+        self.report.write({
+            'py3o_is_local_fusion': False,
+            'py3o_server_balancing': server_pool.LEAST_OUTSTANDING,
+        })
+        server = self.report.py3o_server_id
+        with FusionServerDouble() as fusion_server, \
+                FusionServerDouble() as other_fusion_server, \
+                mock.patch('requests.Session.post', _session_post):
+            server.write({
+                'url': fusion_server.url,
+                'template_dedup': True,
+                # the 503 answer isn't retried on the same server
+                'retries': 0,
+            })
+            self.report.py3o_server_ids = server.copy({
+                'url': other_fusion_server.url,
+            })
+            self.assertEqual('test_result', self._send_fusion_request())
+            self.assertEqual(1, len(fusion_server.templates))
+            # the server knowing the template is unavailable: the request
+            # goes to the other server, with the template
+            fusion_server.unavailable = 1
+            del fusion_server.requests[:]
+            self.assertEqual('test_result', self._send_fusion_request())
+            self.assertEqual(
+                [False],
+                [fields['tmpl_upload'] for fields in fusion_server.requests])
+            self.assertEqual(
+                [True],
+                [fields['tmpl_upload']
+                 for fields in other_fusion_server.requests])
+            server.invalidate_cache()
+            self.assertEqual(1, server.stat_errors)
+        server_pool.reset()
+
+    def test_data_struct_cache(self):
+        template_cache.cache.clear()
+        self.report.py3o_is_local_fusion = False
+        with mock.patch.object(
+                template_cache, 'Py3oConvertor',
+                wraps=template_cache.Py3oConvertor) as convertor, \
+                mock.patch.object(
+                    template_cache.Template,
+                    'get_all_user_python_expression',
+                    autospec=True,
+                    side_effect=template_cache.Template.
+                    get_all_user_python_expression) as get_expressions:
+            for dummy in range(3):
+                self._send_fusion_request()
+        # each record only renders the data structure of the template
+        self.assertEqual(1, convertor.call_count)
+        self.assertEqual(1, get_expressions.call_count)
+
+    def test_batch_requests(self):
+        server_pool.reset()
+        self.report.write({
+            'py3o_is_local_fusion': False,
+            'py3o_filetype': 'odt',
+        })
+        users = self.env['res.users'].search([], limit=3)
+        self.assertEqual(3, len(users))
+        with FusionServerDouble() as fusion_server, \
+                mock.patch('requests.Session.post', _session_post):
+            self.report.py3o_server_id.write({
+                'url': fusion_server.url,
+                'batch_size': 2,
+            })
+            self.assertEqual(2, self.py3o_report._get_conversion_batch_size())
+            # a request per record doesn't need batches
+            self.report.py3o_server_id.batch_size = 1
+            self.assertEqual(0, self.py3o_report._get_conversion_batch_size())
+            self.report.py3o_server_id.batch_size = 2
+            reports_path = self.py3o_report._create_reports_batch_conversion(
+                users, {}, {}, 2)
+            try:
+                self.assertEqual(3, len(set(reports_path)))
+                for report_path in reports_path:
+                    with open(report_path) as report_file:
+                        self.assertEqual('test_result', report_file.read())
+            finally:
+                self.py3o_report._cleanup_tempfiles(reports_path)
+            # the records are sent 2 by 2
+            self.assertEqual(
+                [2, 1],
+                [len(json.loads(fields['datadicts']))
+                 for fields in fusion_server.requests])
+            # without attachments, the server merges the PDF documents
+            del fusion_server.requests[:]
+            self.report.py3o_filetype = 'pdf'
+            reports_path = self.py3o_report._create_reports_batch_conversion(
+                users, {}, {}, 2)
+            self.py3o_report._cleanup_tempfiles(reports_path)
+            self.assertEqual(2, len(reports_path))
+            self.assertEqual(
+                ['1', '1'],
+                [fields.get('merge') for fields in fusion_server.requests])
+        server_pool.reset()
+
+    def test_conversion_batch_size(self):
+        # the local fusion converts the documents one by one
+        self.env['ir.config_parameter'].set_param(
+            'py3o.conversion_batch_size', '3')
+        self.assertEqual(0, self.py3o_report._get_conversion_batch_size())
+
+    def test_serializer(self):
+        value = {
+            'date': datetime.date(2018, 1, 2),
+            'datetime': datetime.datetime(2018, 1, 2, 3, 4, 5),
+            'amount': decimal.Decimal('1.5'),
+            'image': bytearray('image'),
+            'lines': [{'name': u'line \xe9'}] * 1000,
+        }
+        for name in serializer.BACKENDS:
+            json_serializer = serializer.get_serializer(name)
+            data = json_serializer.dumps(value)
+            self.assertEqual(data, ''.join(json_serializer.iterencode(value)))
+            self.assertEqual({
+                'date': '2018-01-02',
+                'datetime': '2018-01-02 03:04:05',
+                'amount': 1.5,
+                'image': 'aW1hZ2U=',
+                'lines': [{'name': u'line \xe9'}] * 1000,
+            }, json.loads(data))
+
+    def test_stream_upload(self):
+        server_pool.reset()
+        self.report.py3o_is_local_fusion = False
+        with FusionServerDouble() as fusion_server, \
+                mock.patch('requests.Session.post', _session_post):
+            self.report.py3o_server_id.write({
+                'url': fusion_server.url,
+                'stream_upload': True,
+            })
+            self.assertEqual('test_result', self._send_fusion_request())
+            # the body has a known length
+            self.assertEqual(0, fusion_server.chunked_requests)
+            fields = fusion_server.requests[0]
+            self.assertTrue(fields['tmpl_upload'])
+            self.assertIsInstance(json.loads(fields['datadict']), dict)
+            # and it is sent again when the server is unavailable
+            del fusion_server.requests[:]
+            fusion_server.unavailable = 1
+            self.assertEqual('test_result', self._send_fusion_request())
+            self.assertEqual(2, len(fusion_server.requests))
+            self.assertEqual(fields, fusion_server.requests[1])
+        server_pool.reset()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""The PDF library of the module: PyPDF2 1.x if installed, pyPdf otherwise.
+
+The watermarks and :class:`StreamingWriter` use internals shared by these
+versions: the ``_data`` of the streams, ``_addObject`` and ``_objects`` of
+the writers, ``resolvedObjects`` of the readers and ``indirectRef`` of the
+pages. PyPDF2 2.0 renamed them, so its later versions are not used.
+"""
+from logging import getLogger
+
+from pyPdf import PdfFileReader, PdfFileWriter
+from pyPdf.generic import ArrayObject, DecodedStreamObject, \
+    DictionaryObject, FloatObject, IndirectObject, NameObject, \
+    NumberObject, PdfObject, StreamObject
+from pyPdf.utils import PdfReadError
+try:
+    import PyPDF2
+except ImportError:
+    PyPDF2 = None
+
+logger = getLogger(__name__)
+
+if PyPDF2 is not None and PyPDF2.__version__.split('.')[0] == '1':
+    from PyPDF2 import PdfFileReader, PdfFileWriter  # pylint: disable=W0404
+    from PyPDF2.generic import ArrayObject, DecodedStreamObject, \
+        DictionaryObject, FloatObject, IndirectObject, NameObject, \
+        NumberObject, PdfObject, StreamObject  # pylint: disable=W0404
+    from PyPDF2.utils import PdfReadError  # pylint: disable=W0404
+elif PyPDF2 is not None:
+    logger.warning(
+        'PyPDF2 %s is not supported, pyPdf is used instead',
+        PyPDF2.__version__)
+
+__all__ = [
+    'ArrayObject', 'DecodedStreamObject', 'DictionaryObject', 'FloatObject',
+    'IndirectObject', 'NameObject', 'NumberObject', 'PdfFileReader',
+    'PdfFileWriter', 'PdfObject', 'PdfReadError', 'StreamObject',
+]
@@ -2,26 +2,24 @@
 # © 2016 Therp BV <http://therp.nl>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 from base64 import b64decode
+from contextlib import closing
+import hashlib
 from logging import getLogger
-from PIL import Image
 from StringIO import StringIO
+import tempfile
 
-from pyPdf import PdfFileWriter, PdfFileReader
-from pyPdf.utils import PdfReadError
-try:
-    from PyPDF2 import PdfFileWriter, PdfFileReader  # pylint: disable=W0404
-    from PyPDF2.utils import PdfReadError  # pylint: disable=W0404
-except ImportError:
-    pass
-try:
-    # we need this to be sure PIL has loaded PDF support
-    from PIL import PdfImagePlugin  # noqa: F401
-except ImportError:
-    pass
 from odoo import api, models, tools
 
+from . import watermark_cache
+from .pdf_lib import PdfFileReader, PdfFileWriter
+from .streaming_writer import StreamingWriter
+
 logger = getLogger(__name__)
 
+# size from which a document watermarked in streaming mode is written to a
+# temporary file rather than kept in memory
+SPOOL_SIZE = 4 * 1024 * 1024
+
 
 class Report(models.Model):
     _inherit = 'report'
@@ -33,61 +31,69 @@ class Report(models.Model):
         report = self._get_report_from_name(report_name)
         watermark = None
         if report.pdf_watermark:
-            watermark = b64decode(report.pdf_watermark)
+            watermark = report.pdf_watermark
         elif report.pdf_watermark_expression:
             watermark = tools.safe_eval(
                 report.pdf_watermark_expression,
                 dict(env=self.env, docs=self.env[report.model].browse(docids)),
             )
-            if watermark:
-                watermark = b64decode(watermark)
 
         if not watermark:
             return result
 
-        pdf = PdfFileWriter()
-        pdf_watermark = None
-        try:
-            pdf_watermark = PdfFileReader(StringIO(watermark))
-        except PdfReadError:
-            # let's see if we can convert this with pillow
-            try:
-                Image.init()
-                image = Image.open(StringIO(watermark))
-                pdf_buffer = StringIO()
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
-                resolution = image.info.get(
-                    'dpi', report.paperformat_id.dpi or 90
-                )
-                if isinstance(resolution, tuple):
-                    resolution = resolution[0]
-                image.save(pdf_buffer, 'pdf', resolution=resolution)
-                pdf_watermark = PdfFileReader(pdf_buffer)
-            except:
-                logger.exception('Failed to load watermark')
-
+        pdf_watermark = self._get_cached_watermark(report, watermark)
         if not pdf_watermark:
-            logger.error(
-                'No usable watermark found, got %s...', watermark[:100]
-            )
             return result
 
-        if pdf_watermark.numPages < 1:
-            logger.error('Your watermark pdf does not contain any pages')
-            return result
-        if pdf_watermark.numPages > 1:
-            logger.debug('Your watermark pdf contains more than one page, '
-                         'all but the first one will be ignored')
+        if self._pdf_watermark_streaming(result):
+            with closing(tempfile.SpooledTemporaryFile(
+                    max_size=SPOOL_SIZE)) as pdf_content:
+                pdf = StreamingWriter(pdf_content)
+                pdf_watermark.apply(
+                    PdfFileReader(StringIO(result)).pages, pdf)
+                pdf.close()
+                # the closed writer doesn't reference the reader anymore:
+                # free the original document before reading the result
+                del result
+                pdf_content.seek(0)
+                return pdf_content.read()
 
-        for page in PdfFileReader(StringIO(result)).pages:
-            watermark_page = pdf.addBlankPage(
-                page.mediaBox.getWidth(), page.mediaBox.getHeight()
-            )
-            watermark_page.mergePage(pdf_watermark.getPage(0))
-            watermark_page.mergePage(page)
+        pdf = PdfFileWriter()
+        pdf_watermark.apply(PdfFileReader(StringIO(result)).pages, pdf)
 
         pdf_content = StringIO()
         pdf.write(pdf_content)
 
         return pdf_content.getvalue()
+
+    @api.model
+    def _pdf_watermark_streaming(self, content):
+        """Whether the watermark is added to the document ``content`` page
+        by page, which needs less memory for big documents
+        """
+        streaming_size = int(self.env['ir.config_parameter'].sudo().get_param(
+            'report_qweb_pdf_watermark.streaming_size', 10 * 1024 * 1024))
+        return bool(streaming_size) and len(content) >= streaming_size
+
+    @api.model
+    def _get_cached_watermark(self, report, watermark):
+        """Return the parsed watermark of ``report`` for the base64 encoded
+        ``watermark``, decoding and parsing it only the first time it is
+        used by this process
+        """
+        dpi = report.paperformat_id.dpi or 90
+        key = watermark_cache.encoded_cache.get((watermark, dpi))
+        if key is not None:
+            pdf_watermark = watermark_cache.cache.get(key)
+            if pdf_watermark is not None:
+                return pdf_watermark
+        data = b64decode(watermark)
+        key = (hashlib.sha256(data).hexdigest(), dpi)
+        pdf_watermark = watermark_cache.cache.get(key)
+        if pdf_watermark is None:
+            pdf_watermark = watermark_cache.load_watermark(data, dpi)
+            if not pdf_watermark:
+                return None
+            watermark_cache.cache[key] = pdf_watermark
+        watermark_cache.encoded_cache[(watermark, dpi)] = key
+        return pdf_watermark
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""A PDF writer writing each page as soon as it is added.
+
+``PdfFileWriter`` keeps every object of the document until it is written,
+and the reader it copies the pages from keeps every object it parsed.
+:class:`StreamingWriter` writes the objects of each page when the page is
+added and makes the readers forget them, so the memory it needs doesn't
+grow with the number of pages.
+"""
+from .pdf_lib import ArrayObject, DictionaryObject, IndirectObject, \
+    NameObject, NumberObject, StreamObject
+
+
+class StreamingWriter(object):
+    """Write a PDF document to ``stream`` page by page.
+
+    The pages are added with :meth:`addPage` and the document is completed
+    by :meth:`close`. Like with ``PdfFileWriter``, other objects are added
+    with :meth:`_addObject`.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        # the objects of the document not written yet, by number - 1
+        self._objects = []
+        self._offsets = []
+        self._written = 0
+        # the objects of the readers by their number in this document
+        self._references = {}
+        self._readers = {}
+        self._pages = []
+        self._pages_node = self._addObject(None)
+        self.stream.write('%PDF-1.3\n%\xe2\xe3\xcf\xd3\n')
+
+    def _addObject(self, obj):
+        self._objects.append(obj)
+        self._offsets.append(None)
+        return IndirectObject(len(self._objects), 0, self)
+
+    def getObject(self, ido):
+        return self._objects[ido.idnum - 1]
+
+    def _reference(self, ido):
+        """Return the reference in this document to the object ``ido`` of
+        a reader, the object being written with the next page
+        """
+        key = (id(ido.pdf), ido.generation, ido.idnum)
+        reference = self._references.get(key)
+        if reference is None:
+            self._readers[id(ido.pdf)] = ido.pdf
+            reference = self._references[key] = self._addObject(ido)
+        return reference
+
+    def _import(self, value):
+        """Return a copy of ``value`` referencing the objects of this
+        document instead of the objects of its reader
+        """
+        if isinstance(value, IndirectObject):
+            if value.pdf is self:
+                return value
+            return self._reference(value)
+        if isinstance(value, StreamObject):
+            stream = value.__class__()
+            stream._data = value._data
+            stream.update(dict(
+                (key, self._import(item)) for key, item in value.items()))
+            return stream
+        if isinstance(value, DictionaryObject):
+            return DictionaryObject(
+                (key, self._import(item))
+                for key, item in dict.items(value))
+        if isinstance(value, ArrayObject):
+            return ArrayObject(self._import(item) for item in value)
+        return value
+
+    def _write_object(self, idnum, obj):
+        self._offsets[idnum - 1] = self.stream.tell()
+        self.stream.write('%d 0 obj\n' % idnum)
+        obj.writeToStream(self.stream, None)
+        self.stream.write('\nendobj\n')
+
+    def _flush(self):
+        """Write the objects added since the previous call"""
+        while self._written < len(self._objects):
+            self._written += 1
+            idnum = self._written
+            obj = self._objects[idnum - 1]
+            if obj is None:
+                # written already, or a page referenced by another one,
+                # written when it is added
+                continue
+            self._objects[idnum - 1] = None
+            if isinstance(obj, IndirectObject):
+                value = obj.getObject()
+                if isinstance(value, DictionaryObject) and \
+                        value.get('/Type') == '/Page':
+                    continue
+                obj = self._import(value)
+            self._write_object(idnum, obj)
+        for reader in self._readers.values():
+            reader.resolvedObjects.clear()
+
+    def addPage(self, page):
+        """Write ``page``, a page of a reader, and the objects it uses"""
+        ref = getattr(page, 'indirectRef', None)
+        if ref is not None and ref.pdf is not self:
+            reference = self._reference(ref)
+        else:
+            reference = self._addObject(None)
+        self._objects[reference.idnum - 1] = None
+        copy = self._import(DictionaryObject(
+            (key, value) for key, value in dict.items(page)
+            if key != '/Parent'))
+        copy[NameObject('/Parent')] = self._pages_node
+        self._write_object(reference.idnum, copy)
+        self._pages.append(reference)
+        self._flush()
+
+    def close(self):
+        """Write the page tree, the catalog and the cross-reference table,
+        then release the readers
+        """
+        self._write_object(self._pages_node.idnum, DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): ArrayObject(self._pages),
+            NameObject('/Count'): NumberObject(len(self._pages)),
+        }))
+        root = self._addObject(DictionaryObject({
+            NameObject('/Type'): NameObject('/Catalog'),
+            NameObject('/Pages'): self._pages_node,
+        }))
+        self._flush()
+        for idnum, offset in enumerate(self._offsets, 1):
+            if offset is None:
+                # a page referenced by another one, but not added
+                self._offsets[idnum - 1] = self.stream.tell()
+                self.stream.write('%d 0 obj\nnull\nendobj\n' % idnum)
+        xref = self.stream.tell()
+        self.stream.write('xref\n0 %d\n' % (len(self._offsets) + 1))
+        self.stream.write('0000000000 65535 f \n')
+        for offset in self._offsets:
+            self.stream.write('%010d 00000 n \n' % offset)
+        self.stream.write('trailer\n')
+        DictionaryObject({
+            NameObject('/Size'): NumberObject(len(self._offsets) + 1),
+            NameObject('/Root'): root,
+        }).writeToStream(self.stream, None)
+        self.stream.write('\nstartxref\n%d\n%%%%EOF\n' % xref)
+        self._readers.clear()
+        self._references.clear()
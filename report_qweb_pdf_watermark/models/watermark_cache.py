@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Per process cache of parsed watermarks.
+
+The first page of a watermark is parsed, or converted from an image, once.
+The base64 encoded values of the reports are mapped to it as well, so a
+watermark returned again by a report is neither decoded nor hashed.
+Its content and resources are kept detached from the document they were
+read from, and copied into each watermarked document as a form XObject
+drawn under the content of its pages. The pages of the same size share one
+form.
+
+Both caches keep the ``CACHE_SIZE`` most recently used entries.
+"""
+from logging import getLogger
+from PIL import Image
+from StringIO import StringIO
+
+try:
+    # we need this to be sure PIL has loaded PDF support
+    from PIL import PdfImagePlugin  # noqa: F401
+except ImportError:
+    pass
+
+from odoo.tools.lru import LRU
+
+from .pdf_lib import ArrayObject, DecodedStreamObject, DictionaryObject, \
+    FloatObject, IndirectObject, NameObject, NumberObject, PdfFileReader, \
+    PdfObject, PdfReadError, StreamObject
+
+logger = getLogger(__name__)
+
+CACHE_SIZE = 16
+
+
+class _Indirect(PdfObject):
+    """An indirect object detached from its document"""
+
+    def __init__(self):
+        self.value = None
+
+
+def _detach(value, memo):
+    """Return a copy of ``value`` resolving its indirect objects, which
+    doesn't need the document it was read from anymore
+    """
+    if isinstance(value, IndirectObject):
+        key = (value.idnum, value.generation)
+        if key not in memo:
+            memo[key] = _Indirect()
+            memo[key].value = _detach(value.getObject(), memo)
+        return memo[key]
+    if isinstance(value, StreamObject):
+        stream = value.__class__()
+        stream._data = value._data
+        stream.update(dict(
+            (key, _detach(item, memo)) for key, item in value.items()))
+        return stream
+    if isinstance(value, DictionaryObject):
+        return DictionaryObject(
+            (key, _detach(item, memo))
+            for key, item in dict.items(value))
+    if isinstance(value, ArrayObject):
+        return ArrayObject(_detach(item, memo) for item in value)
+    return value
+
+
+def _attach(value, writer, memo):
+    """Return a copy of the detached ``value`` belonging to ``writer``"""
+    if isinstance(value, _Indirect):
+        if id(value) not in memo:
+            memo[id(value)] = reference = writer._addObject(None)
+            writer._objects[reference.idnum - 1] = _attach(
+                value.value, writer, memo)
+        return memo[id(value)]
+    if isinstance(value, StreamObject):
+        stream = value.__class__()
+        stream._data = value._data
+        stream.update(dict(
+            (key, _attach(item, writer, memo))
+            for key, item in value.items()))
+        return stream
+    if isinstance(value, DictionaryObject):
+        return DictionaryObject(
+            (key, _attach(item, writer, memo))
+            for key, item in dict.items(value))
+    if isinstance(value, ArrayObject):
+        return ArrayObject(_attach(item, writer, memo) for item in value)
+    return value
+
+
+class CachedWatermark(object):
+    """The first page of a watermark document"""
+
+    def __init__(self, reader):
+        page = reader.getPage(0)
+        contents = page.get('/Contents')
+        if contents is None:
+            self.content = ''
+        elif isinstance(contents.getObject(), ArrayObject):
+            self.content = '\n'.join(
+                stream.getObject().getData()
+                for stream in contents.getObject())
+        else:
+            self.content = contents.getObject().getData()
+        self.resources = _detach(
+            page.get('/Resources', DictionaryObject()), {})
+
+    def _add_form(self, writer, resources, width, height):
+        """Add to ``writer`` the watermark as a form of the given size"""
+        form = DecodedStreamObject()
+        form.setData(self.content)
+        form.update({
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Form'),
+            NameObject('/BBox'): ArrayObject([
+                NumberObject(0), NumberObject(0),
+                FloatObject(width), FloatObject(height)]),
+            NameObject('/Resources'): resources,
+        })
+        return writer._addObject(form)
+
+    def apply(self, pages, writer):
+        """Add ``pages`` to ``writer`` with the watermark under their
+        content
+        """
+        resources = None
+        forms = {}
+        for page in pages:
+            size = (page.mediaBox.getWidth(), page.mediaBox.getHeight())
+            if size not in forms:
+                if resources is None:
+                    resources = _attach(self.resources, writer, {})
+                name = '/OCAWatermark%d' % len(forms)
+                prefix = DecodedStreamObject()
+                prefix.setData('q %s Do Q\n' % name)
+                forms[size] = (
+                    NameObject(name),
+                    self._add_form(writer, resources, *size),
+                    writer._addObject(prefix))
+            _draw_under(page, *forms[size])
+            writer.addPage(page)
+
+
+def _draw_under(page, name, form, prefix):
+    """Draw ``form`` as the XObject ``name`` with the content stream
+    ``prefix`` before the content of ``page``. The resources of the page,
+    which may be shared with other pages, are copied rather than modified.
+    """
+    resources = DictionaryObject()
+    if '/Resources' in page:
+        resources = DictionaryObject(dict.items(page['/Resources']))
+    xobjects = DictionaryObject()
+    if '/XObject' in resources:
+        xobjects = DictionaryObject(dict.items(resources['/XObject']))
+    xobjects[name] = form
+    resources[NameObject('/XObject')] = xobjects
+    page[NameObject('/Resources')] = resources
+    contents = ArrayObject([prefix])
+    if '/Contents' in page:
+        if isinstance(page['/Contents'], ArrayObject):
+            contents.extend(page['/Contents'])
+        else:
+            contents.append(page.get('/Contents'))
+    page[NameObject('/Contents')] = contents
+
+
+def load_watermark(watermark, dpi):
+    """Return the :class:`CachedWatermark` of the PDF document or image
+    ``watermark``, or None if it isn't usable
+    """
+    pdf_watermark = None
+    try:
+        pdf_watermark = PdfFileReader(StringIO(watermark))
+    except PdfReadError:
+        # let's see if we can convert this with pillow
+        try:
+            Image.init()
+            image = Image.open(StringIO(watermark))
+            pdf_buffer = StringIO()
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            resolution = image.info.get('dpi', dpi)
+            if isinstance(resolution, tuple):
+                resolution = resolution[0]
+            image.save(pdf_buffer, 'pdf', resolution=resolution)
+            pdf_watermark = PdfFileReader(pdf_buffer)
+        except Exception:
+            logger.exception('Failed to load watermark')
+
+    if not pdf_watermark:
+        logger.error(
+            'No usable watermark found, got %s...', watermark[:100]
+        )
+        return None
+
+    if pdf_watermark.numPages < 1:
+        logger.error('Your watermark pdf does not contain any pages')
+        return None
+    if pdf_watermark.numPages > 1:
+        logger.debug('Your watermark pdf contains more than one page, '
+                     'all but the first one will be ignored')
+    return CachedWatermark(pdf_watermark)
+
+
+# the parsed watermarks by hash of their decoded data and dpi
+cache = LRU(CACHE_SIZE)
+# the keys in cache of the watermarks as given by the reports, base64
+# encoded, to find them without decoding and hashing them
+encoded_cache = LRU(CACHE_SIZE)
@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 # © 2016 Therp BV <http://therp.nl>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+from base64 import b64decode
+import mock
 from PIL import Image
+from StringIO import StringIO
+
 from odoo.tests.common import HttpCase
 
+from ..models import streaming_writer, watermark_cache
+from ..models.pdf_lib import PdfFileReader
+
 
 class TestReportQwebPdfWatermark(HttpCase):
     def test_report_qweb_pdf_watermark(self):
@@ -29,3 +36,47 @@ class TestReportQwebPdfWatermark(HttpCase):
             'report_qweb_pdf_watermark.demo_report_view',
         )
         self.assertEqual(pdf.count('/Subtype /Image'), number)
+
+    def test_watermark_cache(self):
+        watermark_cache.cache.clear()
+        watermark_cache.encoded_cache.clear()
+        with mock.patch.object(
+                watermark_cache, 'load_watermark',
+                wraps=watermark_cache.load_watermark) as load_watermark:
+            self._test_report_images(3)
+            self._test_report_images(3)
+        # the watermark is converted once
+        self.assertEqual(1, load_watermark.call_count)
+        self.assertEqual(1, len(watermark_cache.cache))
+
+    def test_watermark_expression_cache(self):
+        watermark_cache.encoded_cache.clear()
+        with mock.patch(
+                'odoo.addons.report_qweb_pdf_watermark.models.report'
+                '.b64decode', wraps=b64decode) as decode:
+            self._test_report_images(3)
+            self._test_report_images(3)
+        # the same watermark is decoded once
+        self.assertEqual(1, decode.call_count)
+        self.assertEqual(1, len(watermark_cache.encoded_cache))
+
+    def test_watermark_streaming(self):
+        self.env['ir.config_parameter'].set_param(
+            'report_qweb_pdf_watermark.streaming_size', '1')
+        with mock.patch(
+                'odoo.addons.report_qweb_pdf_watermark.models.report'
+                '.StreamingWriter',
+                wraps=streaming_writer.StreamingWriter) as writer:
+            self._test_report_images(3)
+        self.assertTrue(writer.called)
+        pdf = self.env['report'].get_pdf(
+            self.env['res.users'].search([]).ids,
+            'report_qweb_pdf_watermark.demo_report_view',
+        )
+        self.assertTrue(PdfFileReader(StringIO(pdf)).getNumPages())
+        # the closed writer releases the reader of the original document
+        pdf_writer = streaming_writer.StreamingWriter(StringIO())
+        pdf_writer.addPage(PdfFileReader(StringIO(pdf)).getPage(0))
+        self.assertTrue(pdf_writer._readers)
+        pdf_writer.close()
+        self.assertFalse(pdf_writer._readers)
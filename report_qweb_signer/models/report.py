@@ -6,6 +6,7 @@
 import base64
 from contextlib import closing
 import os
+import shlex
 import subprocess
 import tempfile
 import time
@@ -14,6 +15,8 @@ from odoo import models, api, _
 from odoo.exceptions import UserError, AccessError
 from odoo.tools.safe_eval import safe_eval
 
+from . import signing_pool
+
 import logging
 _logger = logging.getLogger(__name__)
 
@@ -31,17 +34,15 @@ def _normalize_filepath(path):
 class Report(models.Model):
     _inherit = 'report'
 
+    def _certificate_candidates(self, report):
+        if report.report_type != 'qweb-pdf':
+            return []
+        return self.env['report.certificate']._candidates_get(
+            self.env.user.company_id, report.model)
+
     def _certificate_get(self, report, docids):
         """Obtain the proper certificate for the report and the conditions."""
-        if report.report_type != 'qweb-pdf':
-            return False
-        certificates = self.env['report.certificate'].search([
-            ('company_id', '=', self.env.user.company_id.id),
-            ('model_id', '=', report.model),
-        ])
-        if not certificates:
-            return False
-        for cert in certificates:
+        for cert, domain in self._certificate_candidates(report):
             # Check allow only one document
             if cert.allow_only_one and len(self) > 1:
                 _logger.debug(
@@ -50,10 +51,9 @@ class Report(models.Model):
                     cert.name, len(docids))
                 continue
             # Check domain
-            if cert.domain:
-                domain = [('id', 'in', tuple(docids))]
-                domain = domain + safe_eval(cert.domain)
-                docs = self.env[cert.model_id.model].search(domain)
+            if domain:
+                domain = [('id', 'in', tuple(docids))] + domain
+                docs = self.env[report.model].search(domain, limit=1)
                 if not docs:
                     _logger.debug(
                         "Certificate '%s' domain not satisfied", cert.name)
@@ -62,6 +62,25 @@ class Report(models.Model):
             return cert
         return False
 
+    def _certificates_get(self, report, docids):
+        """Obtain the certificate signing the document of each record, when
+        printed alone, as a dictionary by record id. The records matching
+        the domain of each certificate are searched at once."""
+        certificates = dict.fromkeys(docids, False)
+        todo = list(docids)
+        for cert, domain in self._certificate_candidates(report):
+            if not todo:
+                break
+            if domain:
+                matched = set(self.env[report.model].search(
+                    [('id', 'in', todo)] + domain).ids)
+            else:
+                matched = set(todo)
+            for docid in matched:
+                certificates[docid] = cert
+            todo = [docid for docid in todo if docid not in matched]
+        return certificates
+
     def _attach_filename_get(self, docids, certificate):
         if len(docids) != 1:
             return False
@@ -106,20 +125,111 @@ class Report(models.Model):
                   'You do not have enough access rights to save attachments'))
         return attachment
 
+    def _attach_signed_read_many(self, docids, certificate):
+        """Return the stored signed documents of the records as a dictionary
+        by record id, with a single search."""
+        filenames = {}
+        for docid in docids:
+            filename = self._attach_filename_get([docid], certificate)
+            if filename:
+                filenames[docid] = filename
+        if not filenames:
+            return {}
+        attachments = self.env['ir.attachment'].search([
+            ('datas_fname', 'in', list(set(filenames.values()))),
+            ('res_model', '=', certificate.model_id.model),
+            ('res_id', 'in', filenames.keys()),
+        ])
+        contents = {}
+        for attachment in attachments:
+            if attachment.res_id in contents or \
+                    filenames[attachment.res_id] != attachment.datas_fname:
+                continue
+            contents[attachment.res_id] = base64.decodestring(
+                attachment.datas)
+        return contents
+
+    def _attach_signed_write_many(self, certificate, contents):
+        """Store the signed documents given by record id"""
+        values = []
+        for docid, signed in contents.items():
+            filename = self._attach_filename_get([docid], certificate)
+            if filename:
+                values.append({
+                    'name': filename,
+                    'datas': base64.encodestring(signed),
+                    'datas_fname': filename,
+                    'res_model': certificate.model_id.model,
+                    'res_id': docid,
+                })
+        attachments = self.env['ir.attachment']
+        try:
+            for vals in values:
+                attachments |= self.env['ir.attachment'].create(vals)
+        except AccessError:
+            raise UserError(
+                _('Saving signed report (PDF): '
+                  'You do not have enough access rights to save attachments'))
+        return attachments
+
     def _signer_bin(self, opts):
         me = os.path.dirname(__file__)
         java_bin = 'java -jar'
         jar = '{}/../static/jar/jPdfSign.jar'.format(me)
         return '%s %s %s' % (java_bin, jar, opts)
 
-    def pdf_sign(self, pdf, certificate):
-        pdfsigned = pdf + '.signed.pdf'
+    def _signer_server_cmd(self):
+        """Command starting a long-lived signer, see JPdfSignServer.java"""
+        me = os.path.dirname(__file__)
+        static = os.path.normpath('{}/../static'.format(me))
+        jar = '{}/jar/jPdfSignServer.jar'.format(static)
+        classpath = '{}/jar/itext-1.4.8.jar'.format(static)
+        if os.path.exists(jar):
+            main = ['JPdfSignServer']
+            classpath += os.pathsep + jar
+        else:
+            # java 11 runs the source file directly
+            main = ['{}/src/java/JPdfSignServer.java'.format(static)]
+        return ['java'] + shlex.split(os.environ.get('JVM_ARGS', '')) + \
+            ['-cp', classpath] + main
+
+    def _signing_pool_params(self):
+        """Return the number of signers of each Odoo process and the
+        keyword arguments of their pool, from the system parameters
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return int(get_param('report_qweb_signer.signing_workers', 0)), {
+            'max_jobs': int(get_param(
+                'report_qweb_signer.signing_max_jobs', 1000)),
+            'timeout': int(get_param(
+                'report_qweb_signer.signing_timeout', 120)),
+        }
+
+    def _signing_pool(self):
+        """Return the pool of long-lived signers, or None if each document
+        has to be signed by its own signer
+        """
+        # the signers are opt-in: they need Java 11 or a compiled
+        # JPdfSignServer
+        size, kwargs = self._signing_pool_params()
+        if size <= 0:
+            return None
+        return signing_pool.get_pool(
+            self._signer_server_cmd(), size, **kwargs)
+
+    def _certificate_files(self, certificate):
+        """Return the paths of the PKCS#12 and password files of
+        ``certificate``"""
         p12 = _normalize_filepath(certificate.path)
         passwd = _normalize_filepath(certificate.password_file)
         if not (p12 and passwd):
             raise UserError(
                 _('Signing report (PDF): '
                   'Certificate or password file not found'))
+        return p12, passwd
+
+    def _pdf_sign_command(self, p12, passwd, pdf, pdfsigned):
+        """Sign the file ``pdf`` into ``pdfsigned`` with its own signer"""
         signer_opts = '"%s" "%s" "%s" "%s"' % (p12, pdf, pdfsigned, passwd)
         signer = self._signer_bin(signer_opts)
         process = subprocess.Popen(
@@ -130,8 +240,99 @@ class Report(models.Model):
                 _('Signing report (PDF): jPdfSign failed (error code: %s). '
                   'Message: %s. Output: %s') %
                 (process.returncode, err, out))
+
+    def pdf_sign(self, pdf, certificate):
+        """Sign the file ``pdf`` and return the path of the signed file.
+
+        The file is signed by a process of :meth:`_signing_pool` when the
+        signing workers are enabled, or by its own signer otherwise.
+        """
+        pdfsigned = pdf + '.signed.pdf'
+        p12, passwd = self._certificate_files(certificate)
+        pool = self._signing_pool()
+        if pool:
+            try:
+                pool.sign(p12, passwd, pdf, pdfsigned)
+                return pdfsigned
+            except signing_pool.SigningUnavailable as e:
+                _logger.warning(
+                    'Signing report (PDF): %s. Starting a signer for the '
+                    'document.', e)
+            except signing_pool.SigningError as e:
+                raise UserError(
+                    _('Signing report (PDF): jPdfSign failed. Message: %s') %
+                    e)
+        self._pdf_sign_command(p12, passwd, pdf, pdfsigned)
         return pdfsigned
 
+    def _pdf_sign_content(self, content, certificate):
+        """Sign the PDF document ``content`` with :meth:`pdf_sign` and return
+        the signed one. The temporary files are removed even if the signing
+        fails.
+        """
+        # Creating temporary origin PDF
+        pdf_fd, pdf = tempfile.mkstemp(
+            suffix='.pdf', prefix='report.tmp.')
+        signed = pdf + '.signed.pdf'
+        try:
+            with closing(os.fdopen(pdf_fd, 'w')) as pf:
+                pf.write(content)
+            signed = self.pdf_sign(pdf, certificate)
+            # Read signed PDF
+            if os.path.exists(signed):
+                with open(signed, 'rb') as pf:
+                    content = pf.read()
+        finally:
+            # Manual cleanup of the temporary files
+            for fname in (pdf, signed):
+                try:
+                    if os.path.exists(fname):
+                        os.unlink(fname)
+                except (OSError, IOError):
+                    _logger.error('Error when trying to remove file %s', fname)
+        return content
+
+    @api.model
+    def get_signed_pdfs(self, docids, report_name, data=None):
+        """Render and sign the document of each record separately, and store
+        the signed documents as attachments when their certificate says so.
+
+        The documents are signed one after the other with :meth:`pdf_sign`,
+        and the attachments are looked up and created together.
+
+        :return: the PDF documents by record id, not signed for the records
+            without certificate
+        """
+        report = self._get_report_from_name(report_name)
+        certificates = self._certificates_get(report, docids)
+        contents = {}
+        for certificate in set(certificates.values()):
+            if certificate and certificate.attachment:
+                contents.update(self._attach_signed_read_many(
+                    [docid for docid in docids
+                     if certificates[docid] == certificate], certificate))
+        _logger.debug(
+            "%d signed PDF documents of '%s' loaded from the database",
+            len(contents), report_name)
+        signed = {}
+        for docid in docids:
+            if docid in contents:
+                continue
+            content = super(Report, self).get_pdf(
+                [docid], report_name, data=data)
+            certificate = certificates[docid]
+            if certificate:
+                _logger.debug(
+                    "Signing PDF document '%s' for ID %s with certificate "
+                    "'%s'", report_name, docid, certificate.name)
+                content = self._pdf_sign_content(content, certificate)
+                if certificate.attachment:
+                    signed.setdefault(certificate, {})[docid] = content
+            contents[docid] = content
+        for certificate, certificate_contents in signed.items():
+            self._attach_signed_write_many(certificate, certificate_contents)
+        return contents
+
     @api.model
     def get_pdf(self, docids, report_name, html=None, data=None):
         report = self._get_report_from_name(report_name)
@@ -148,26 +349,11 @@ class Report(models.Model):
             docids, report_name, html=html, data=data,
         )
         if certificate:
-            # Creating temporary origin PDF
-            pdf_fd, pdf = tempfile.mkstemp(
-                suffix='.pdf', prefix='report.tmp.')
-            with closing(os.fdopen(pdf_fd, 'w')) as pf:
-                pf.write(content)
             _logger.debug(
                 "Signing PDF document '%s' for IDs %s with certificate '%s'",
                 report_name, docids, certificate.name,
             )
-            signed = self.pdf_sign(pdf, certificate)
-            # Read signed PDF
-            if os.path.exists(signed):
-                with open(signed, 'rb') as pf:
-                    content = pf.read()
-            # Manual cleanup of the temporary files
-            for fname in (pdf, signed):
-                try:
-                    os.unlink(fname)
-                except (OSError, IOError):
-                    _logger.error('Error when trying to remove file %s', fname)
+            content = self._pdf_sign_content(content, certificate)
             if certificate.attachment:
                 self._attach_signed_write(docids, certificate, content)
         return content
@@ -2,7 +2,8 @@
 # © 2015 Antiun Ingenieria S.L. - Antonio Espinosa
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo import api, fields, models
+from odoo import api, fields, models, tools
+from odoo.tools.safe_eval import safe_eval
 
 
 class ReportCertificate(models.Model):
@@ -40,3 +41,45 @@ class ReportCertificate(models.Model):
     company_id = fields.Many2one(
         string='Company', comodel_name='res.company',
         required=True, default=_default_company)
+
+    @api.model
+    def create(self, vals):
+        res = super(ReportCertificate, self).create(vals)
+        self.clear_caches()
+        return res
+
+    @api.multi
+    def write(self, vals):
+        res = super(ReportCertificate, self).write(vals)
+        self.clear_caches()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super(ReportCertificate, self).unlink()
+        self.clear_caches()
+        return res
+
+    @api.model
+    @tools.ormcache('self.env.uid', 'company_id', 'model')
+    def _get_candidates(self, company_id, model):
+        """Return the certificates of the current user which may sign the
+        documents of ``model`` for ``company_id``, in order of preference,
+        as tuples of their id and their evaluated domain.
+        """
+        certificates = self.search([
+            ('company_id', '=', company_id),
+            ('model_id', '=', model),
+        ])
+        return tuple(
+            (cert.id, tuple(safe_eval(cert.domain)) if cert.domain else ())
+            for cert in certificates)
+
+    @api.model
+    def _candidates_get(self, company, model):
+        """Return the candidates of :meth:`_get_candidates` as tuples of
+        certificate and domain.
+        """
+        return [
+            (self.browse(cert_id), list(domain))
+            for cert_id, domain in self._get_candidates(company.id, model)]
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Java signers kept running between the signed reports.
+
+Starting a JVM and loading a certificate costs more than signing most
+documents. A signer runs ``static/src/java/JPdfSignServer.java``, reads
+one request per line on its standard input and answers each of them on
+its standard output. The documents are exchanged either as file names or
+as bytes following the request and the answer.
+"""
+import atexit
+import logging
+import subprocess
+import tempfile
+import threading
+import time
+import Queue
+
+_logger = logging.getLogger(__name__)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class SigningError(Exception):
+    """The signer refused to sign a document"""
+
+
+class SigningUnavailable(SigningError):
+    """No signer could be started or the signer crashed"""
+
+
+class SigningWorker(object):
+    """One JPdfSignServer process and the requests sent to it"""
+
+    def __init__(self, command, start_timeout=60):
+        self.command = command
+        self.start_timeout = start_timeout
+        self.jobs = 0
+        self.process = None
+        self.stderr = None
+        self.timed_out = False
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _read_answer(self, timeout, size=None):
+        """Return the next line written by the signer, or the next ``size``
+        bytes, killing it if it doesn't answer within ``timeout`` seconds
+        """
+        timer = threading.Timer(timeout, self._timeout)
+        timer.start()
+        try:
+            if size is None:
+                data = self.process.stdout.readline()
+                complete = data.endswith('\n')
+            else:
+                data = self.process.stdout.read(size)
+                complete = len(data) == size
+        finally:
+            timer.cancel()
+        if not complete:
+            self.process.wait()
+            if self.timed_out:
+                raise SigningError(
+                    'PDF signer killed after %s seconds' % timeout)
+            raise SigningUnavailable(
+                'PDF signer exited with code %s: %s' % (
+                    self.process.returncode, self._errors()))
+        return data if size is not None else data[:-1]
+
+    def _errors(self):
+        if self.stderr is None:
+            return ''
+        self.stderr.seek(0)
+        return self.stderr.read()[-2000:]
+
+    def start(self):
+        self.stderr = tempfile.TemporaryFile(prefix='report.signer.')
+        try:
+            self.process = subprocess.Popen(
+                self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=self.stderr, close_fds=True)
+        except OSError as e:
+            raise SigningUnavailable(
+                'Unable to start the PDF signer %s: %s' % (self.command, e))
+        try:
+            answer = self._read_answer(self.start_timeout)
+        except SigningError as e:
+            self.stop()
+            raise SigningUnavailable(str(e))
+        if answer != 'READY':
+            self.stop()
+            raise SigningUnavailable(
+                'Unexpected answer of the PDF signer %s' % (self.command, ))
+        _logger.debug('PDF signer %s started', self.process.pid)
+
+    def _timeout(self):
+        self.timed_out = True
+        self.kill()
+
+    def kill(self):
+        if self.is_alive():
+            _logger.warning('PDF signer %s stopped by force',
+                            self.process.pid)
+            self.process.kill()
+
+    def stop(self):
+        if self.is_alive():
+            try:
+                self.process.stdin.write('QUIT\n')
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            for dummy in range(20):
+                if self.process.poll() is not None:
+                    break
+                time.sleep(0.1)
+            self.kill()
+        if self.process is not None:
+            self.process.wait()
+        if self.stderr is not None:
+            self.stderr.close()
+            self.stderr = None
+
+    def request(self, fields, timeout, data=None):
+        """Send a request, followed by ``data`` if given, and return the
+        answer of the signer
+        """
+        line = '\t'.join(fields)
+        if '\n' in line:
+            raise SigningError('Invalid signing request %r' % (line, ))
+        try:
+            self.process.stdin.write(line + '\n')
+            if data is not None:
+                self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except (IOError, OSError) as e:
+            raise SigningUnavailable('PDF signer crashed: %s' % e)
+        answer = self._read_answer(timeout)
+        if answer.startswith('ERROR'):
+            raise SigningError(answer[6:])
+        self.jobs += 1
+        return answer
+
+    def sign(self, p12, passwd, pdf, pdfsigned, timeout):
+        self.request(['SIGN', p12, passwd, pdf, pdfsigned], timeout)
+
+    def sign_data(self, p12, passwd, content, timeout):
+        answer = self.request(
+            ['SIGNDATA', p12, passwd, str(len(content))], timeout,
+            data=content)
+        try:
+            size = int(answer.split(' ', 1)[1])
+        except (IndexError, ValueError):
+            # the rest of the answer can't be told from the next one
+            self.kill()
+            raise SigningUnavailable(
+                'Unexpected answer of the PDF signer: %r' % (answer, ))
+        return self._read_answer(timeout, size=size)
+
+
+class SigningPool(object):
+    """The signers of an Odoo process, each one used by a single request
+    at a time. When the JVM can't be started, no new signer is tried for
+    :attr:`retry_delay` seconds, so the documents are signed by the
+    fallback command without waiting for it.
+
+    :param command: the argument list running ``JPdfSignServer``
+    :param size: how many signers may run at the same time
+    :param max_jobs: documents signed by a signer before it is replaced by
+        a fresh JVM, 0 for no limit
+    :param timeout: seconds given to a signer to answer a request
+    """
+
+    # seconds during which no signer is started after a failure
+    retry_delay = 60
+
+    def __init__(self, command, size, max_jobs=0, timeout=120):
+        self.command = command
+        self.size = size
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.unavailable_until = 0
+        # a replaced pool stops its signers once they are released
+        self.draining = False
+        self._idle = Queue.LifoQueue()
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        if self.unavailable_until > time.time():
+            raise SigningUnavailable('The PDF signer failed to start')
+        with self._lock:
+            spawn = self._count < self.size
+            if spawn:
+                self._count += 1
+        if not spawn:
+            try:
+                return self._idle.get(timeout=self.timeout)
+            except Queue.Empty:
+                raise SigningUnavailable(
+                    'All the PDF signers stayed busy for %s seconds' %
+                    self.timeout)
+        worker = SigningWorker(self.command)
+        try:
+            worker.start()
+        except Exception:
+            self.unavailable_until = time.time() + self.retry_delay
+            self._discard(worker)
+            raise
+        return worker
+
+    def _discard(self, worker):
+        with self._lock:
+            self._count -= 1
+        worker.stop()
+
+    def _release(self, worker):
+        with self._lock:
+            keep = not self.draining and worker.is_alive() and not (
+                self.max_jobs and worker.jobs >= self.max_jobs)
+            if keep:
+                self._idle.put(worker)
+        if not keep:
+            _logger.debug('Replacing PDF signer, %d documents signed',
+                          worker.jobs)
+            self._discard(worker)
+
+    def _run(self, method, *args):
+        """Call ``method`` of a signer, trying again with a new signer if
+        the first one crashed
+        """
+        for attempt in (1, 2):
+            worker = self._acquire()
+            try:
+                return getattr(worker, method)(*args + (self.timeout, ))
+            except SigningUnavailable:
+                if attempt == 2 or worker.is_alive():
+                    raise
+                _logger.warning('PDF signer crashed, trying again')
+            finally:
+                self._release(worker)
+
+    def sign(self, p12, passwd, pdf, pdfsigned):
+        """Sign the file ``pdf`` into ``pdfsigned``"""
+        self._run('sign', p12, passwd, pdf, pdfsigned)
+
+    def sign_data(self, p12, passwd, content):
+        """Return the PDF document ``content`` signed, without writing it
+        to a file
+        """
+        return self._run('sign_data', p12, passwd, content)
+
+    def shutdown(self):
+        """Stop the signers waiting for a request"""
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            self._discard(worker)
+
+    def drain(self):
+        """Stop the signers waiting for a request, and the busy ones as soon
+        as they are released
+        """
+        with self._lock:
+            self.draining = True
+        self.shutdown()
+
+
+def get_pool(command, size, max_jobs=0, timeout=120):
+    """Return the :class:`SigningPool` running ``command``. When the
+    system parameters tuning it were changed, the previous pool is drained
+    and a new pool is returned.
+    """
+    key = (tuple(command), size, max_jobs, timeout)
+    with _pools_lock:
+        pool = _pools.get(key[0])
+        if pool is not None and (
+                tuple(pool.command), pool.size, pool.max_jobs,
+                pool.timeout) != key:
+            pool.drain()
+            pool = None
+        if pool is None:
+            pool = _pools[key[0]] = SigningPool(
+                command, size, max_jobs, timeout)
+        return pool
+
+
+@atexit.register
+def shutdown_pools():
+    """Stop the JVMs when Odoo exits"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown()
+        _pools.clear()
@@ -0,0 +1,191 @@
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.EOFException;
+import java.io.File;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.security.KeyStore;
+import java.security.PrivateKey;
+import java.security.cert.Certificate;
+import java.util.Enumeration;
+import java.util.HashMap;
+import java.util.Map;
+
+import com.lowagie.text.pdf.PdfReader;
+import com.lowagie.text.pdf.PdfSignatureAppearance;
+import com.lowagie.text.pdf.PdfStamper;
+
+/**
+ * Long-lived PDF signer, driven through stdin/stdout.
+ *
+ * It writes "READY" once started, then answers each request line, whose
+ * fields are separated by tabs:
+ *
+ * SIGN pkcs12FileName passwordFileName pdfInputFileName pdfOutputFileName
+ *     signs a file, answers "OK" or "ERROR message"
+ * SIGNDATA pkcs12FileName passwordFileName length
+ *     signs the document of length bytes following the request line,
+ *     answers "OK length" followed by the signed document of that many
+ *     bytes, or "ERROR message"
+ * QUIT
+ *     stops the signer
+ *
+ * The PKCS#12 certificates are loaded once, then kept until their file is
+ * modified.
+ *
+ * Signs the documents the same way as JPdfSign.
+ */
+public class JPdfSignServer {
+
+    private static class SigningKey {
+        PrivateKey privateKey;
+        Certificate[] certificateChain;
+        long lastModified;
+    }
+
+    private static Map<String, SigningKey> keys =
+        new HashMap<String, SigningKey>();
+
+    public static void main(String[] args) throws IOException {
+        InputStream in = new BufferedInputStream(System.in);
+        PrintStream out = new PrintStream(
+            new BufferedOutputStream(System.out), false, "UTF-8");
+        // the answers are the only output on stdout
+        System.setOut(System.err);
+        out.print("READY\n");
+        out.flush();
+        String line;
+        while ((line = readLine(in)) != null) {
+            String[] fields = line.split("\t", -1);
+            try {
+                if (fields[0].equals("QUIT")) {
+                    break;
+                } else if (fields[0].equals("SIGN") && fields.length == 5) {
+                    SigningKey key = getKey(fields[1], fields[2]);
+                    InputStream pdf = new FileInputStream(fields[3]);
+                    try {
+                        OutputStream signed = new FileOutputStream(fields[4]);
+                        try {
+                            sign(pdf, signed, key);
+                        } finally {
+                            signed.close();
+                        }
+                    } finally {
+                        pdf.close();
+                    }
+                    out.print("OK\n");
+                } else if (fields[0].equals("SIGNDATA")
+                           && fields.length == 4) {
+                    // the document is read even if the key can't be loaded
+                    byte[] pdf = readBytes(in, Integer.parseInt(fields[3]));
+                    SigningKey key = getKey(fields[1], fields[2]);
+                    ByteArrayOutputStream signed = new ByteArrayOutputStream(
+                        pdf.length + 16384);
+                    sign(new ByteArrayInputStream(pdf), signed, key);
+                    out.print("OK " + signed.size() + "\n");
+                    signed.writeTo(out);
+                } else {
+                    out.print("ERROR Invalid request\n");
+                }
+            } catch (Exception e) {
+                e.printStackTrace();
+                out.print("ERROR " + String.valueOf(e).replace('\n', ' ')
+                          + "\n");
+            }
+            out.flush();
+        }
+    }
+
+    /** Read a line of UTF-8 text, null at the end of the input */
+    protected static String readLine(InputStream in) throws IOException {
+        ByteArrayOutputStream line = new ByteArrayOutputStream();
+        int c;
+        while ((c = in.read()) != '\n') {
+            if (c < 0) {
+                return line.size() > 0 ? line.toString("UTF-8") : null;
+            }
+            line.write(c);
+        }
+        return line.toString("UTF-8");
+    }
+
+    /** Read exactly length bytes */
+    protected static byte[] readBytes(InputStream in, int length)
+            throws IOException {
+        byte[] data = new byte[length];
+        int offset = 0;
+        while (offset < length) {
+            int r = in.read(data, offset, length - offset);
+            if (r < 0) {
+                throw new EOFException();
+            }
+            offset += r;
+        }
+        return data;
+    }
+
+    protected static char[] readPassword(String pwdFile) throws IOException {
+        ByteArrayOutputStream pwd = new ByteArrayOutputStream();
+        InputStream pwdfis = new FileInputStream(pwdFile);
+        try {
+            byte[] buf = new byte[1024];
+            int r;
+            while ((r = pwdfis.read(buf)) >= 0) {
+                pwd.write(buf, 0, r);
+            }
+        } finally {
+            pwdfis.close();
+        }
+        return pwd.toString().trim().toCharArray();
+    }
+
+    protected static SigningKey getKey(String pkcs12FileName, String pwdFile)
+            throws Exception {
+        String cacheKey = pkcs12FileName + "\t" + pwdFile;
+        long lastModified = Math.max(
+            new File(pkcs12FileName).lastModified(),
+            new File(pwdFile).lastModified());
+        SigningKey key = keys.get(cacheKey);
+        if (key != null && key.lastModified == lastModified) {
+            return key;
+        }
+        char[] password = readPassword(pwdFile);
+        KeyStore ks = KeyStore.getInstance("pkcs12");
+        InputStream p12 = new FileInputStream(pkcs12FileName);
+        try {
+            ks.load(p12, password);
+        } finally {
+            p12.close();
+        }
+        Enumeration<String> aliases = ks.aliases();
+        if (!aliases.hasMoreElements()) {
+            throw new Exception("The PKCS#12 file " + pkcs12FileName
+                                + " does not contain any private keys.");
+        }
+        String alias = aliases.nextElement();
+        key = new SigningKey();
+        key.privateKey = (PrivateKey) ks.getKey(alias, password);
+        key.certificateChain = ks.getCertificateChain(alias);
+        key.lastModified = lastModified;
+        keys.put(cacheKey, key);
+        return key;
+    }
+
+    protected static void sign(InputStream pdf, OutputStream signed,
+                               SigningKey key) throws Exception {
+        PdfReader reader = new PdfReader(pdf);
+        PdfStamper stp = PdfStamper.createSignature(
+            reader, signed, '\0', null, true);
+        PdfSignatureAppearance sap = stp.getSignatureAppearance();
+        sap.setCrypto(key.privateKey, key.certificateChain, null,
+                      PdfSignatureAppearance.WINCER_SIGNED);
+        sap.setCertified(true);
+        stp.close();
+    }
+}
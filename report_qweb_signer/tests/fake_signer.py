@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""A stand-in for JPdfSignServer, appending a line to the documents.
+
+It crashes on a file holding ``CRASH`` the first time it sees it, and
+refuses the documents holding ``FAIL``.
+"""
+import os
+import sys
+
+SIGNATURE = '\n%signed\n'
+
+
+def main():
+    sys.stdout.write('READY\n')
+    sys.stdout.flush()
+    while True:
+        line = sys.stdin.readline()
+        if not line or line == 'QUIT\n':
+            break
+        fields = line[:-1].split('\t')
+        if fields[0] == 'SIGN':
+            with open(fields[3], 'rb') as pdf:
+                data = pdf.read()
+            if data == 'CRASH' and not os.path.exists(fields[3] + '.crash'):
+                open(fields[3] + '.crash', 'w').close()
+                sys.exit(1)
+            if data == 'FAIL':
+                sys.stdout.write('ERROR Invalid document\n')
+            else:
+                with open(fields[4], 'wb') as signed:
+                    signed.write(data + SIGNATURE)
+                sys.stdout.write('OK\n')
+        elif fields[0] == 'SIGNDATA':
+            data = sys.stdin.read(int(fields[3]))
+            if data == 'FAIL':
+                sys.stdout.write('ERROR Invalid document\n')
+            else:
+                signed = data + SIGNATURE
+                sys.stdout.write('OK %d\n%s' % (len(signed), signed))
+        else:
+            sys.stdout.write('ERROR Invalid request\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
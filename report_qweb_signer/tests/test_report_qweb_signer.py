@@ -2,7 +2,18 @@
 # Copyright 2017 Tecnativa - Pedro M. Baeza
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+import mock
+import os
+import shutil
+import sys
+import tempfile
+
+from odoo.exceptions import UserError
 from odoo.tests.common import HttpCase
+from odoo.tools.safe_eval import safe_eval
+
+from ..models import signing_pool
+from . import fake_signer
 
 
 class TestReportQwebSigner(HttpCase):
@@ -22,3 +33,241 @@ class TestReportQwebSigner(HttpCase):
         self.env['report'].get_pdf(
             self.partner.ids, self.report.report_name, data={},
         )
+
+    def _fake_signer_cmd(self):
+        """Enable the signing processes and return the command starting
+        the fake signer"""
+        self.env['ir.config_parameter'].set_param(
+            'report_qweb_signer.signing_workers', '1')
+        return [sys.executable,
+                os.path.splitext(fake_signer.__file__)[0] + '.py']
+
+    def test_signing_pool(self):
+        report = self.env['report']
+        certificate = self.env.ref('report_qweb_signer.demo_certificate_test')
+        command = self._fake_signer_cmd()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(
+                    type(report), '_signer_server_cmd',
+                    return_value=command):
+                pool = report._signing_pool()
+                self.assertEqual(command, pool.command)
+                p12, passwd = report._certificate_files(certificate)
+                for content in ('document', 'CRASH'):
+                    pdf = os.path.join(tmp_dir, 'document.pdf')
+                    signed = pdf + '.signed.pdf'
+                    with open(pdf, 'wb') as pdf_file:
+                        pdf_file.write(content)
+                    # a crashed signer is replaced
+                    pool.sign(p12, passwd, pdf, signed)
+                    with open(signed, 'rb') as signed_file:
+                        self.assertEqual(
+                            content + fake_signer.SIGNATURE,
+                            signed_file.read())
+                with open(pdf, 'wb') as pdf_file:
+                    pdf_file.write('FAIL')
+                with self.assertRaises(UserError):
+                    report.pdf_sign(pdf, certificate)
+                # the signer is kept for the next documents
+                self.assertEqual(1, pool._count)
+        finally:
+            shutil.rmtree(tmp_dir)
+            signing_pool.shutdown_pools()
+
+    def test_signing_pool_replaced(self):
+        command = [sys.executable,
+                   os.path.splitext(fake_signer.__file__)[0] + '.py']
+        pool = signing_pool.get_pool(command, 2)
+        try:
+            busy = pool._acquire()
+            idle = pool._acquire()
+            pool._release(idle)
+            # new settings replace the pool
+            self.assertIsNot(
+                pool, signing_pool.get_pool(command, 2, max_jobs=5))
+            self.assertFalse(idle.is_alive())
+            # its busy signers are stopped once released
+            self.assertTrue(busy.is_alive())
+            pool._release(busy)
+            self.assertFalse(busy.is_alive())
+            self.assertEqual(0, pool._count)
+        finally:
+            signing_pool.shutdown_pools()
+
+    def test_get_signed_pdfs(self):
+        report = self.env['report']
+        partners = self.partner | self.env['res.partner'].create({
+            'name': 'Other partner',
+            'customer': True,
+        }) | self.env['res.partner'].create({
+            'name': 'Supplier',
+            'customer': False,
+        })
+        certificate = self.env.ref('report_qweb_signer.demo_certificate_test')
+        report_class = type(report)
+        try:
+            with mock.patch.object(
+                    report_class, '_signer_server_cmd',
+                    return_value=self._fake_signer_cmd()), \
+                    mock.patch.object(
+                        report_class, '_pdf_sign_content', autospec=True,
+                        side_effect=report_class._pdf_sign_content) as sign:
+                contents = report.get_signed_pdfs(
+                    partners.ids, self.report.report_name)
+        finally:
+            signing_pool.shutdown_pools()
+        self.assertEqual(set(partners.ids), set(contents))
+        # each document of a customer is signed separately
+        self.assertEqual(
+            [certificate] * len(partners.filtered('customer')),
+            [call[0][2] for call in sign.call_args_list])
+        # the documents are signed when their record matches the domain
+        for partner in partners:
+            self.assertEqual(
+                partner.customer,
+                contents[partner.id].endswith(fake_signer.SIGNATURE))
+        attachments = self.env['ir.attachment'].search([
+            ('res_model', '=', 'res.partner'),
+            ('res_id', 'in', partners.ids),
+        ])
+        self.assertEqual(
+            set(partners.filtered('customer').ids),
+            set(attachments.mapped('res_id')))
+        # the signed documents are loaded from the attachments
+        with mock.patch.object(report_class, '_pdf_sign_content') as sign:
+            self.assertEqual(
+                contents[self.partner.id],
+                report.get_signed_pdfs(
+                    self.partner.ids, self.report.report_name)[
+                        self.partner.id])
+        self.assertFalse(sign.called)
+
+    def test_get_signed_pdfs_without_workers(self):
+        report = self.env['report']
+        partners = self.partner | self.env['res.partner'].create({
+            'name': 'Other partner',
+            'customer': True,
+        })
+        report_class = type(report)
+
+        def sign_command(report, p12, passwd, pdf, pdfsigned):
+            shutil.copy(pdf, pdfsigned)
+            with open(pdfsigned, 'ab') as signed_file:
+                signed_file.write(fake_signer.SIGNATURE)
+
+        with mock.patch.object(
+                report_class, '_pdf_sign_command', autospec=True,
+                side_effect=sign_command) as command, \
+                mock.patch.object(
+                    signing_pool.SigningWorker, 'start') as start:
+            contents = report.get_signed_pdfs(
+                partners.ids, self.report.report_name)
+        for partner in partners:
+            self.assertTrue(
+                contents[partner.id].endswith(fake_signer.SIGNATURE))
+        # without signing workers, no signing process is started: each
+        # document has its own signer
+        self.assertFalse(start.called)
+        self.assertEqual(len(partners), command.call_count)
+
+    def test_certificate_cache(self):
+        report = self.env['report']
+        certificate = self.env.ref('report_qweb_signer.demo_certificate_test')
+        other = self.env['res.partner'].create({
+            'name': 'Supplier',
+            'customer': False,
+        })
+        ids = [self.partner.id, other.id]
+        self.env['report.certificate'].clear_caches()
+        with mock.patch(
+                'odoo.addons.report_qweb_signer.models.report_certificate'
+                '.safe_eval', side_effect=safe_eval) as mocked_eval:
+            self.assertEqual(
+                certificate,
+                report._certificate_get(self.report, self.partner.ids))
+            self.assertEqual(
+                {self.partner.id: certificate, other.id: False},
+                report._certificates_get(self.report, ids))
+            self.assertEqual(
+                certificate, report._certificate_get(self.report, ids))
+        # the domain is evaluated once
+        self.assertEqual(1, mocked_eval.call_count)
+        # and again once the certificates changed
+        certificate.domain = "[('customer', '=', False)]"
+        self.assertFalse(
+            report._certificate_get(self.report, self.partner.ids))
+
+    def test_certificate_rules(self):
+        report = self.env['report']
+        certificate = self.env.ref('report_qweb_signer.demo_certificate_test')
+        user = self.env['res.users'].create({
+            'name': 'Certificate user',
+            'login': 'certificate_user',
+            'groups_id': [(6, 0, [self.env.ref('base.group_user').id])],
+        })
+        self.env['ir.rule'].create({
+            'name': 'Hidden certificate',
+            'model_id': self.env.ref(
+                'report_qweb_signer.model_report_certificate').id,
+            'domain_force': "[('id', '!=', %d)]" % certificate.id,
+            'groups': [(6, 0, [self.env.ref('base.group_user').id])],
+        })
+        self.assertEqual(
+            certificate,
+            report._certificate_get(self.report, self.partner.ids))
+        # the certificates are searched with the rights of the user
+        self.assertFalse(report.sudo(user)._certificate_get(
+            self.report, self.partner.ids))
+
+    def test_pdf_sign_content(self):
+        report = self.env['report']
+        certificate = self.env.ref('report_qweb_signer.demo_certificate_test')
+        temporary_files = []
+
+        def mkstemp(*args, **kwargs):
+            result = mkstemp_orig(*args, **kwargs)
+            temporary_files.append(result[1])
+            return result
+
+        mkstemp_orig = tempfile.mkstemp
+        try:
+            with mock.patch.object(
+                    type(report), '_signer_server_cmd',
+                    return_value=self._fake_signer_cmd()), \
+                    mock.patch.object(tempfile, 'mkstemp', mkstemp):
+                content = '%PDF' + ''.join(map(chr, range(256))) * 1000
+                self.assertEqual(
+                    content + fake_signer.SIGNATURE,
+                    report._pdf_sign_content(content, certificate))
+                with self.assertRaises(UserError):
+                    report._pdf_sign_content('FAIL', certificate)
+                # the signer is kept for the next documents
+                self.assertEqual(
+                    'next' + fake_signer.SIGNATURE,
+                    report._pdf_sign_content('next', certificate))
+        finally:
+            signing_pool.shutdown_pools()
+        # the temporary files are removed, even after a failure
+        self.assertEqual(3, len(temporary_files))
+        for path in temporary_files:
+            self.assertFalse(os.path.exists(path))
+            self.assertFalse(os.path.exists(path + '.signed.pdf'))
+
+    def test_pdf_sign_override(self):
+        report = self.env['report']
+        certificate = self.env.ref('report_qweb_signer.demo_certificate_test')
+
+        def pdf_sign(pdf, certificate):
+            with open(pdf, 'ab') as pdf_file:
+                pdf_file.write('custom signature')
+            return pdf
+
+        with mock.patch.object(
+                type(report), 'pdf_sign', side_effect=pdf_sign) as sign:
+            # the printed documents are signed by pdf_sign
+            content = report.get_pdf(
+                self.partner.ids, self.report.report_name, data={})
+        self.assertTrue(content.endswith('custom signature'))
+        self.assertEqual(
+            [certificate], [call[0][1] for call in sign.call_args_list])